@@ -0,0 +1,181 @@
+import io
+import os
+import queue
+import tarfile
+import threading
+import time
+import zipfile
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, BinaryIO, Optional, Union
+
+import structlog
+
+from attachment_store import AttachmentStore
+
+if TYPE_CHECKING:
+    from eml_unpack import Attachment
+
+logger = structlog.getLogger(__name__)
+
+
+class MemoryviewReader(io.RawIOBase):
+    """A read-only file object over a buffer, so the bytes can be streamed without copying them first."""
+
+    def __init__(self, buffer: memoryview):
+        self._buffer = buffer.cast("B") if buffer.ndim else buffer
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = min(len(b), len(self._buffer) - self._pos)
+        b[:n] = self._buffer[self._pos: self._pos + n]
+        self._pos += n
+        return n
+
+
+class AttachmentSink(ABC):
+    """Receives attachments one by one while an email is being parsed.
+
+    EMLExtractor calls ``consume``, which writes the attachment and then releases its bytes, so a
+    sink must not keep a reference to them after ``write`` returns. Subclasses implement ``write``.
+    """
+
+    @abstractmethod
+    def write(self, attachment: "Attachment") -> None:
+        """Writes one attachment."""
+
+    def consume(self, attachment: "Attachment") -> None:
+        try:
+            self.write(attachment)
+        finally:
+            attachment.release()
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def attachment_name(attachment: "Attachment") -> str:
+        return attachment.name or "attachment"
+
+
+class DirectorySink(AttachmentSink):
+    """Writes attachments as files into a folder, through an AttachmentStore when one is passed."""
+
+    def __init__(self, dirname: str, store: Optional[AttachmentStore] = None):
+        self.dirname = dirname
+        self.store = store
+        os.makedirs(dirname, exist_ok=True)
+
+    def write(self, attachment: "Attachment") -> None:
+        path = os.path.join(self.dirname, self.attachment_name(attachment))
+        if self.store:
+            self.store.store(attachment.getbuffer(), path)
+            return
+        with open(path, "wb") as f:
+            attachment.write_to(f)
+
+
+class TarSink(AttachmentSink):
+    """Streams attachments into a tar archive, a path or any writable (even unseekable) file object."""
+
+    def __init__(self, target: Union[str, BinaryIO], prefix: str = "", compression: str = ""):
+        mode = f"w|{compression}"
+        if isinstance(target, str):
+            self.tar = tarfile.open(target, mode)
+        else:
+            self.tar = tarfile.open(fileobj=target, mode=mode)
+        self.prefix = prefix
+
+    def write(self, attachment: "Attachment") -> None:
+        info = tarfile.TarInfo(os.path.join(self.prefix, self.attachment_name(attachment)))
+        info.size = attachment.size
+        info.mtime = int(time.time())
+        self.tar.addfile(info, MemoryviewReader(attachment.getbuffer()))
+
+    def close(self) -> None:
+        self.tar.close()
+
+
+class ZipSink(AttachmentSink):
+    """Streams attachments into a zip archive."""
+
+    def __init__(self, target: Union[str, BinaryIO], prefix: str = ""):
+        self.zip = zipfile.ZipFile(target, "w", compression=zipfile.ZIP_DEFLATED)
+        self.prefix = prefix
+
+    def write(self, attachment: "Attachment") -> None:
+        with self.zip.open(os.path.join(self.prefix, self.attachment_name(attachment)), "w") as f:
+            attachment.write_to(f)
+
+    def close(self) -> None:
+        self.zip.close()
+
+
+class ObjectStoreSink(AttachmentSink):
+    """Uploads attachments to an S3-like object store, client being anything with boto3's upload_fileobj."""
+
+    def __init__(self, client, bucket: str, prefix: str = ""):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def write(self, attachment: "Attachment") -> None:
+        key = "/".join(p for p in (self.prefix.rstrip("/"), self.attachment_name(attachment)) if p)
+        self.client.upload_fileobj(
+            MemoryviewReader(attachment.getbuffer()),
+            self.bucket,
+            key,
+            ExtraArgs={"ContentType": attachment.content_type},
+        )
+
+
+class BackgroundSink(AttachmentSink):
+    """Hands attachments to another sink on a background thread.
+
+    Parsing and body rendering carry on while the previous attachments are written. At most
+    ``max_pending`` attachments wait to be written, after that ``write`` blocks, which bounds memory.
+    The first error raised by the wrapped sink is re-raised from ``close``.
+    """
+
+    def __init__(self, sink: AttachmentSink, max_pending: int = 4):
+        self.sink = sink
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="attachment-sink", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            attachment = self._queue.get()
+            if attachment is None:
+                break
+            try:
+                if self._error is None:
+                    self.sink.write(attachment)
+            except BaseException as e:
+                logger.error(f"Failed writing {attachment.name}", exc_info=e)
+                self._error = e
+            finally:
+                attachment.release()
+
+    def write(self, attachment: "Attachment") -> None:
+        self._queue.put(attachment)
+
+    def consume(self, attachment: "Attachment") -> None:
+        # released by the writer thread once it is written
+        self._queue.put(attachment)
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        self.sink.close()
+        if self._error is not None:
+            raise self._error
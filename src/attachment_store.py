@@ -0,0 +1,66 @@
+import hashlib
+import os
+import shutil
+import uuid
+from typing import Dict
+
+
+def content_sha256(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+class AttachmentStore:
+    """A content addressed blob store for attachments.
+
+    Every distinct attachment is written once under ``root/ab/cd/<sha256>``; the per-email paths
+    are hard links to that blob (or copies when the destination is on another filesystem), so
+    downstream stages can tell duplicates apart by inode or by the recorded digest.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def put(self, content: bytes) -> str:
+        """Writes content to the store unless it is already there.
+
+        Args:
+            content (bytes): The attachment payload, any bytes-like object (e.g. a memoryview) works.
+
+        Returns:
+            str: The SHA-256 hex digest the blob is stored under.
+        """
+        digest = content_sha256(content)
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write next to the target and rename, parallel writers of the same blob can't see a partial file;
+            # created 0666 less the umask like a plain open(), not 0600 like mkstemp
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        return digest
+
+    def link(self, digest: str, dest_path: str) -> None:
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(self.blob_path(digest), dest_path)
+        except OSError:
+            shutil.copyfile(self.blob_path(digest), dest_path)
+
+    def store(self, content: bytes, dest_path: str) -> Dict:
+        """Puts content in the store and links it to dest_path.
+
+        Returns:
+            dict: A lightweight reference with 'sha256', 'size' and 'path'.
+        """
+        digest = self.put(content)
+        self.link(digest, dest_path)
+        return {'sha256': digest, 'size': len(content), 'path': dest_path}
@@ -0,0 +1,97 @@
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+import boto3
+from botocore.config import Config
+
+
+session = boto3.Session(
+    aws_access_key_id='',
+    aws_secret_access_key='',
+    region_name='eu-west-1'
+)
+
+# pools sized for the Textract drivers' thread pools, connections are kept alive between calls
+MAX_POOL_CONNECTIONS = 64
+
+CLIENT_CONFIGS = {
+    # run_pages owns the backoff for Textract, throttling and transient errors alike (see
+    # textract_pipeline.call_with_backoff); botocore retrying underneath would hide throttling from it
+    'textract': Config(max_pool_connections=MAX_POOL_CONNECTIONS, tcp_keepalive=True,
+                       retries={'mode': 'standard', 'max_attempts': 1}),
+    's3': Config(max_pool_connections=MAX_POOL_CONNECTIONS, tcp_keepalive=True,
+                 retries={'mode': 'standard', 'max_attempts': 5}),
+}
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def get_session() -> boto3.Session:
+    """Returns this thread's boto3 session; sessions aren't thread safe, so they are never shared."""
+    if not hasattr(_local, 'session'):
+        with _lock:
+            _local.session = boto3.Session(region_name=session.region_name)
+            _local.clients = {}
+            _local.resources = {}
+    return _local.session
+
+
+def get_client(service: str, endpoint_url: Optional[str] = None):
+    """Returns this thread's client for a service, created once with a pooled keep-alive config.
+
+    Credentials, endpoint resolution and the TLS connection pool are set up on the first call only;
+    every later call in the same thread reuses them.
+    """
+    get_session()
+    key = (service, endpoint_url)
+    if key not in _local.clients:
+        with _lock:
+            _local.clients[key] = _local.session.client(
+                service, endpoint_url=endpoint_url, config=CLIENT_CONFIGS.get(service))
+    return _local.clients[key]
+
+
+def get_resource(service: str, endpoint_url: Optional[str] = None):
+    """Returns this thread's resource for a service, see get_client."""
+    get_session()
+    key = (service, endpoint_url)
+    if key not in _local.resources:
+        with _lock:
+            _local.resources[key] = _local.session.resource(
+                service, endpoint_url=endpoint_url, config=CLIENT_CONFIGS.get(service))
+    return _local.resources[key]
+
+
+def benchmark_client_overhead(endpoint_url: str, n: int = 100) -> Dict:
+    """Times n S3 calls with a client created per call (the old way) and with the shared client.
+
+    Meant to run against a local moto server, e.g. ``moto_server -p 5000`` and
+    ``python aws_clients.py http://127.0.0.1:5000``.
+
+    Returns:
+        dict: Seconds per call for both ways.
+    """
+    bucket = 'client-overhead-benchmark'
+    get_client('s3', endpoint_url).create_bucket(
+        Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': session.region_name})
+
+    s = time.perf_counter()
+    for _ in range(n):
+        boto3.client('s3', endpoint_url=endpoint_url, region_name=session.region_name).head_bucket(Bucket=bucket)
+    per_call_new = (time.perf_counter() - s) / n
+
+    s = time.perf_counter()
+    for _ in range(n):
+        get_client('s3', endpoint_url).head_bucket(Bucket=bucket)
+    per_call_shared = (time.perf_counter() - s) / n
+
+    stats = {'new_client_per_call_seconds': per_call_new, 'shared_client_per_call_seconds': per_call_shared}
+    print(f'new client per call: {per_call_new * 1000:.2f} ms, shared client: {per_call_shared * 1000:.2f} ms')
+    return stats
+
+
+if __name__ == '__main__':
+    benchmark_client_overhead(sys.argv[1] if len(sys.argv) > 1 else 'http://127.0.0.1:5000')
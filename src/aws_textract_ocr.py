@@ -10,44 +10,49 @@ import time
 import psutil
 import time
 import math
-from typing import List, Dict
+from contextlib import nullcontext
+from typing import List, Dict, Optional
 
-from PIL import Image, ImageDraw, ImageFont
+from aws_clients import session, get_client, get_resource
+from ocr_cache import OcrCache, put_result
+from page_index import fan_out_results, select_pages
+from textract_blocks import BlockWriter, block_type_counts
+from textract_overlay import render_overlay, render_overlays, result_key
+from textract_pipeline import load_completed, run_pages
 
+RESULT_FOLDER = 'aws_textract_ocr'
+# fraction of the processed pages that get a debugging overlay, 0 for none
+OVERLAY_SAMPLE_RATE = 0.0
 
-session = boto3.Session(
-    aws_access_key_id='',
-    aws_secret_access_key='',
-    region_name='eu-west-1'
-)
 
-
-def process_text_detection(bucket: str, s3_conn: session.resource('s3'), document: str):
+def process_text_detection(bucket: str, s3_conn: session.resource('s3'), document: str, client=None,
+                           overlay: bool = False, block_writer: Optional[BlockWriter] = None,
+                           local_dir: Optional[str] = None, cache: Optional[OcrCache] = None):
     stats = {}
     nower = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
 
-    # Get the document from S3
     # s3_connection = session.resource('s3')
     # boto3.resource('s3')
-    s3_object = s3_conn.Object(bucket, document)
-    s3_response = s3_object.get()
-
-    stream = io.BytesIO(s3_response['Body'].read())
-    image = Image.open(stream)
+    s3_client = s3_conn.meta.client if s3_conn is not None else get_client('s3')
 
     # Detect text in the document
-    client = boto3.client('textract')
+    client = client or get_client('textract')
     # process using image bytes
 
-    # process using S3 object
-    response = client.detect_document_text(
-        Document={'S3Object': {'Bucket': bucket, 'Name': document}})
-
-    dst_folder = '/'.join(document.split('/')[0:-2])
-    dst_folder = f'{dst_folder}/aws_textract_ocr'
-    dst = f"{dst_folder}/{document.split('/')[-1].split('.')[0]}.json"
-
-    result = s3_conn.meta.client.put_object(Body=json.dumps(response), Bucket=bucket, Key=dst)
+    dst = result_key(document, RESULT_FOLDER)
+
+    # pages whose content was OCR'd before, here or in a duplicated attachment, reuse that response
+    lookup = nullcontext() if cache is None else cache.page(s3_client, bucket, document, 'detect_document_text', (),
+                                                            dst)
+    with lookup as cached:
+        if cached is not None and cached.hit:
+            response = cached.response
+        else:
+            # process using S3 object, the page is only downloaded when an overlay is drawn
+            response = client.detect_document_text(
+                Document={'S3Object': {'Bucket': bucket, 'Name': document}})
+        result = put_result(s3_client, bucket, dst, response, cached)
+    stats['ocr_cache'] = (cached.source or 'miss') if cached is not None else None
 
     res = result.get('ResponseMetadata')
     if res.get('HTTPStatusCode') == 200:
@@ -57,91 +62,36 @@ def process_text_detection(bucket: str, s3_conn: session.resource('s3'), documen
         stats['upload_json_state'] = res.get('HTTPStatusCode')
         stats['upload_json_state_msg'] = 'File Uploaded Unsuccessfully'
 
-    dest_tmp_file = os.path.join('results', f'data_{nower}')
-    with open(f'{dest_tmp_file}.json', 'w') as outfile:
-        json.dump(response, outfile)
+    # the S3 JSON is the record, a local copy is only kept when asked for
+    if local_dir:
+        dest_tmp_file = os.path.join(local_dir, f"data_{nower}_{document.split('/')[-1].split('.')[0]}")
+        with open(f'{dest_tmp_file}.json', 'w') as outfile:
+            json.dump(response, outfile)
 
     # Get the text blocks
     blocks = response['Blocks']
-    width, height = image.size
-    draw = ImageDraw.Draw(image)
     stats['msg'] = {}
     stats['msg']['init'] = 'Detected Document Text'
 
-    # Create image showing bounding box/polygon the detected lines/text
-    stats['msgs'] = []
-    for block in blocks:
-        stats['msgs'].append('Type: ' + block['BlockType'])
-        if block['BlockType'] != 'PAGE':
-            stats['msgs'].append('Detected: ' + block['Text'])
-            stats['msgs'].append('Confidence: ' + "{:.2f}".format(block['Confidence']) + "%")
-        stats['msgs'].append('Id: {}'.format(block['Id']))
-        if 'Relationships' in block:
-            stats['msgs'].append('Relationships: {}'.format(block['Relationships']))
-        stats['msgs'].append('Bounding Box: {}'.format(block['Geometry']['BoundingBox']))
-        stats['msgs'].append('Polygon: {}'.format(block['Geometry']['Polygon']))
-        draw = ImageDraw.Draw(image)
-        # Draw WORD - Green -  start of word, red - end of word
-        if block['BlockType'] == "WORD":
-            draw.line([(width * block['Geometry']['Polygon'][0]['X'],
-                        height * block['Geometry']['Polygon'][0]['Y']),
-                       (width * block['Geometry']['Polygon'][3]['X'],
-                        height * block['Geometry']['Polygon'][3]['Y'])], fill='green',
-                      width=2)
-
-            draw.line([(width * block['Geometry']['Polygon'][1]['X'],
-                        height * block['Geometry']['Polygon'][1]['Y']),
-                       (width * block['Geometry']['Polygon'][2]['X'],
-                        height * block['Geometry']['Polygon'][2]['Y'])], fill='red',
-                      width=2)
-
-            # Draw box around entire LINE
-        if block['BlockType'] == "LINE":
-            points = []
-
-            for polygon in block['Geometry']['Polygon']:
-                points.append((width * polygon['X'], height * polygon['Y']))
-
-            draw.polygon((points), outline='black')
-
-            # Uncomment to draw bounding box
-            box=block['Geometry']['BoundingBox']
-            left = width * box['Left']
-            top = height * box['Top']
-            draw.rectangle([left,top, left + (width * box['Width']), top + (height * box['Height'])], outline='blue')
-
-    # Display the image
-    dst = f"{dst_folder}/{document.split('/')[-1].split('.')[0]}.png"
-
-    # Save the image to an in-memory file
-    in_mem_file = io.BytesIO()
-    image.save(in_mem_file, "PNG")
-    in_mem_file.seek(0)
-
-    image.save(f"{dest_tmp_file}.png", "PNG")
-    result = s3_conn.meta.client.put_object(Body=in_mem_file, Bucket=bucket, Key=dst)
-    # result = s3_conn.upload_fileobj(in_mem_file, bucket, dst)
+    # one row per block in the columnar store instead of formatted strings in the stats
+    stats['block_types'] = block_type_counts(blocks)
+    if block_writer is not None:
+        block_writer.add(document, response)
 
-    res = result.get('ResponseMetadata')
-    if res.get('HTTPStatusCode') == 200:
-        print('File Uploaded Successfully')
-    else:
-        print('File Not Uploaded')
+    if overlay:
+        stats.update(render_overlay(bucket, document, RESULT_FOLDER, response))
 
     stats['msg']['end'] = len(blocks)
     return stats
 
 
-def get_png_images(bucket: str, s3_conn: session.resource('s3'), fldr: str) -> List:
-    bucket = s3_conn.Bucket(bucket)
-    pngs = []
-    for obj in bucket.objects.filter(Prefix=fldr):
-        if obj.key.split('/')[-1].split('.')[-1] == 'png' and obj.key.split('/')[
-            -1].split('.')[0].split('-')[-1] in ['5', '6', '7', '8', '9',
-                                                 '05', '06', '07', '08', '09', '10',
-                                                 '005', '006', '007', '008', '009', '010']:
-            pngs.append(obj.key)
-    return pngs
+def get_png_images(bucket: str, s3_conn: session.resource('s3'), fldr: str, pages: str = '5-10',
+                   refresh: bool = False, skip_blank: bool = True, skip_near_blank: bool = True) -> List:
+    # pages come from the local page index, the prefix is only listed again once that listing is
+    # MAX_INDEX_AGE old (or on refresh); pages s01 triaged blank or near_blank (features/page_triage.json,
+    # e.g. fax covers) are not sent to Textract, skip_near_blank=False keeps near_blank ones for signatures
+    return select_pages(bucket, fldr, pages, kind='page_thumbnails', refresh=refresh, skip_blank=skip_blank,
+                        skip_near_blank=skip_near_blank)
 '''
     # if obj.key.split('/')[-1].split('.')[-1] == 'png' and obj.key.split('/')[-1].split('.')[0].split('-')[
     #        -1] in ['1', '2', '3', '4', '5', '6', '7', '8', '9',
@@ -152,7 +102,7 @@ def get_png_images(bucket: str, s3_conn: session.resource('s3'), fldr: str) -> L
 
 if __name__ == '__main__':
     bucket = 'email-science-data'
-    s3_connection = session.resource('s3')
+    s3_connection = get_resource('s3')
     # fldr = 'axa-poc/Financial_Lines_att_images/'
     fldr = 'email_annotation/markel_manual_todo/attachments_att_images'
     # fldr = 'axa-poc/Fleet_email_submissions_att_images/'
@@ -162,27 +112,25 @@ if __name__ == '__main__':
 
     arr = get_png_images(bucket, s3_connection, fldr)
 
-    rr = []
-    total = len(arr)
-    s0 = time.perf_counter()
-    for index, e in enumerate(arr):
-        s = time.perf_counter()
-        try:
-            res = process_text_detection(bucket, s3_connection, e)
-            res['file'] = e
-            res['exec_time_seconds'] = time.perf_counter() - s
-        except Exception as ex:
-            res = {}
-            res['file'] = e
-            res['exec_time_seconds'] = time.perf_counter() - s
-            res['err'] = str(ex)
-
-        rr.append(res)
-        print(f'{index+1}/{total} processing file {e} cost: {time.perf_counter() - s} seconds')
-    print(f'total processing costs: {time.perf_counter() - s0} seconds')
+    # s3_conn=None makes every worker thread use its own pooled clients from aws_clients
+    results_file = f'all_stats_{fldr.strip("/").replace("/", "_")}.jsonl'
+    with BlockWriter(os.path.join('results', 'blocks', RESULT_FOLDER), fldr) as block_writer, \
+            OcrCache(check_s3=True) as cache:
+        rr = run_pages(arr, lambda e: process_text_detection(bucket, None, e, block_writer=block_writer, cache=cache),
+                       concurrency=8, results_file=results_file)
+        print(f'OCR cache: {cache.summary()}')
 
 
     with open(f'all_stats_{nower}.json', 'w') as outfile:
         json.dump(rr, outfile)
 
+    done = load_completed(results_file)
+    # forms s01 deduplicated onto a processed one get copies of its results
+    fan_out_results(bucket, [p for p in arr if p in done], RESULT_FOLDER)
+
+    # debugging overlays are a separate stage over a sample of the processed pages
+    if OVERLAY_SAMPLE_RATE:
+        render_overlays(bucket, [p for p in arr if p in done], RESULT_FOLDER, sample_rate=OVERLAY_SAMPLE_RATE,
+                        concurrency=8, results_file=f'overlay_stats_{fldr.strip("/").replace("/", "_")}.jsonl')
+
 
@@ -0,0 +1,185 @@
+import html as html_lib
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence
+
+import fitz
+import pdfkit  # type: ignore
+import structlog
+
+logger = structlog.getLogger(__name__)
+
+
+class RenderError(OSError):
+    # an OSError so the existing "pdfkit crashed" fallbacks keep catching it
+    pass
+
+
+class BodyRenderer(ABC):
+    """Turns email body HTML into PDF bytes.
+
+    Subclasses implement ``render_batch``; ``render`` is a batch of one.
+    """
+
+    def render(self, html: str) -> bytes:
+        pdf = self.render_batch([html])[0]
+        if pdf is None:
+            raise RenderError(f"{type(self).__name__} failed to render the document")
+        return pdf
+
+    @abstractmethod
+    def render_batch(self, htmls: Sequence[str]) -> list[Optional[bytes]]:
+        """Renders several documents, a failed one is None in the result."""
+
+
+class PdfkitRenderer(BodyRenderer):
+    """The original behaviour, one wkhtmltopdf process per document through pdfkit."""
+
+    def __init__(self, options: Optional[dict] = None):
+        self.options = options
+
+    def render_batch(self, htmls: Sequence[str]) -> list[Optional[bytes]]:
+        pdfs: list[Optional[bytes]] = []
+        for html in htmls:
+            try:
+                pdfs.append(pdfkit.from_string(html, options=self.options))
+            except OSError as e:
+                logger.error(f"{type(self).__name__} crashed :(", exc_info=e)
+                pdfs.append(None)
+        return pdfs
+
+
+def _quote_arg(arg: str) -> str:
+    # wkhtmltopdf splits the lines of --read-args-from-stdin on whitespace, honouring double quotes
+    # and backslash escapes, so paths with spaces (a TMPDIR like that) have to be quoted
+    return '"' + arg.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class WkhtmltopdfPool(BodyRenderer):
+    """Renders batches of HTML with a bounded number of wkhtmltopdf processes.
+
+    wkhtmltopdf has no request/response server mode, so no process is kept warm between calls;
+    with ``--read-args-from-stdin`` one process converts any number of documents instead, and a
+    batch is split over at most ``size`` processes. The start-up cost is only shared when callers
+    hand over many bodies at once, eml_unpack.render_bodies does that for a batch of emails; a
+    single ``render`` still starts one wkhtmltopdf. Concurrent callers never run more than
+    ``size`` instances at once.
+    """
+
+    def __init__(
+        self,
+        size: int = 2,
+        binary: Optional[str] = None,
+        timeout: int = 120,
+        options: Sequence[str] = ("--quiet", "--encoding", "utf-8"),
+    ):
+        self.size = size
+        self.binary = binary or shutil.which("wkhtmltopdf") or "wkhtmltopdf"
+        self.timeout = timeout
+        self.options = list(options)
+        self._slots = threading.BoundedSemaphore(size)
+        self._executor = ThreadPoolExecutor(max_workers=size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def render_batch(self, htmls: Sequence[str]) -> list[Optional[bytes]]:
+        if not htmls:
+            return []
+        chunk_size = -(-len(htmls) // self.size)
+        chunks = [htmls[i: i + chunk_size] for i in range(0, len(htmls), chunk_size)]
+        pdfs: list[Optional[bytes]] = []
+        for chunk_pdfs in self._executor.map(self._render_chunk, chunks):
+            pdfs.extend(chunk_pdfs)
+        return pdfs
+
+    def _render_chunk(self, htmls: Sequence[str]) -> list[Optional[bytes]]:
+        workdir = tempfile.mkdtemp(prefix="wkhtmltopdf_")
+        try:
+            jobs = []
+            for i, html in enumerate(htmls):
+                in_path = os.path.join(workdir, f"{i}.html")
+                with open(in_path, "w", encoding="utf-8") as f:
+                    f.write(html)
+                jobs.append((in_path, os.path.join(workdir, f"{i}.pdf")))
+
+            args = "".join(
+                " ".join(_quote_arg(a) for a in [*self.options, in_path, out_path]) + "\n" for in_path, out_path in jobs
+            )
+            with self._slots:
+                try:
+                    subprocess.run(
+                        [self.binary, "--read-args-from-stdin"],
+                        input=args.encode(),
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                        timeout=self.timeout * len(jobs),
+                    )
+                except subprocess.TimeoutExpired:
+                    logger.error(f"wkhtmltopdf timed out on a batch of {len(jobs)}")
+
+            pdfs: list[Optional[bytes]] = []
+            for _, out_path in jobs:
+                if os.path.exists(out_path) and os.path.getsize(out_path):
+                    with open(out_path, "rb") as f:
+                        pdfs.append(f.read())
+                else:
+                    pdfs.append(None)
+            return pdfs
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+
+class FitzTextRenderer(BodyRenderer):
+    """Lays out HTML (or plain text) with PyMuPDF's Story, no external process involved.
+
+    Good enough for the plain text fallback and simple bodies, it doesn't do CSS layout like a
+    browser engine.
+    """
+
+    def __init__(self, paper: str = "a4", margin: float = 36, font_size: int = 10):
+        self.paper = paper
+        self.margin = margin
+        self.font_size = font_size
+
+    def render_text(self, text: str) -> bytes:
+        body = html_lib.escape(text).replace("\n", "<br>")
+        return self.render(f'<p style="font-family: sans-serif; font-size: {self.font_size}pt">{body}</p>')
+
+    def render_batch(self, htmls: Sequence[str]) -> list[Optional[bytes]]:
+        pdfs: list[Optional[bytes]] = []
+        for html in htmls:
+            try:
+                pdfs.append(self._render_one(html))
+            except Exception as e:
+                # any Story/DocumentWriter error fails this document only, not the whole batch
+                logger.error(f"{type(self).__name__} failed to lay out the document", exc_info=e)
+                pdfs.append(None)
+        return pdfs
+
+    def _render_one(self, html: str) -> bytes:
+        buffer = io.BytesIO()
+        writer = fitz.DocumentWriter(buffer)
+        story = fitz.Story(html=html)
+        mediabox = fitz.paper_rect(self.paper)
+        where = mediabox + (self.margin, self.margin, -self.margin, -self.margin)
+        more = 1
+        while more:
+            device = writer.begin_page(mediabox)
+            more, _ = story.place(where)
+            story.draw(device)
+            writer.end_page()
+        writer.close()
+        return buffer.getvalue()
@@ -1,30 +1,207 @@
 
+import base64
+import binascii
 import dataclasses
 import email
+import functools
+import hashlib
+import io
+import mmap
 import re
-from typing import Callable, Optional
+import shutil
+import tempfile
+from typing import BinaryIO, Callable, Optional, Sequence, Union
 
 import bs4  # type: ignore
 import fitz
-import pdfkit  # type: ignore
 import structlog
 
+from attachment_sinks import AttachmentSink
+from body_renderer import BodyRenderer, FitzTextRenderer, PdfkitRenderer
+
 logger = structlog.getLogger(__name__)
 
 
 Mail = email.message.EmailMessage
 
+# an img src that names an attachment by filename is usually a path or url, split it into candidate filenames
+SRC_SEPARATORS = re.compile(r"[/\\:?#@&=]")
+
+
+# attachments bigger than this are decoded straight into a temporary file instead of memory
+SPILL_THRESHOLD = 8 * 1024 * 1024
+DECODE_CHUNK_SIZE = 1024 * 1024
+
+
+class Payload:
+    """Decoded attachment bytes, held in memory up to spill_threshold and in a temporary file beyond it.
+
+    ``getbuffer`` gives a memoryview over the bytes without copying them (over the in-memory buffer
+    or an mmap of the file), ``write_to`` streams them to a file object.
+    """
+
+    def __init__(self, spill_threshold: int = SPILL_THRESHOLD):
+        self.spill_threshold = spill_threshold
+        self.size = 0
+        self._file: Union[io.BytesIO, BinaryIO] = io.BytesIO()
+        self._spilled = False
+        self._mmap: Optional[mmap.mmap] = None
+
+    @classmethod
+    def from_mail(cls, mail: Mail, spill_threshold: int = SPILL_THRESHOLD) -> Optional["Payload"]:
+        """Decodes the body of a non-multipart part chunk by chunk, None if it has no decodable body."""
+        if mail.is_multipart():
+            return None
+        payload = cls(spill_threshold)
+        encoding = str(mail.get("Content-Transfer-Encoding", "")).strip().lower()
+        try:
+            if encoding == "base64":
+                payload._decode_base64(mail.get_payload())
+                return payload
+            if encoding == "quoted-printable":
+                payload._decode_quoted_printable(mail.get_payload())
+                return payload
+        except (binascii.Error, ValueError, UnicodeEncodeError):
+            # leave broken encodings to the lenient stdlib decoder, the part decoded so far may have spilled
+            payload.close()
+            payload = cls(spill_threshold)
+        decoded = mail.get_payload(decode=True)
+        if not isinstance(decoded, bytes):
+            return None
+        payload.write(decoded)
+        return payload
+
+    def _decode_base64(self, text: str) -> None:
+        leftover = ""
+        for i in range(0, len(text), DECODE_CHUNK_SIZE):
+            chunk = leftover + "".join(text[i: i + DECODE_CHUNK_SIZE].split())
+            cut = len(chunk) - len(chunk) % 4
+            self.write(binascii.a2b_base64(chunk[:cut]))
+            leftover = chunk[cut:]
+        if leftover.strip("="):
+            self.write(binascii.a2b_base64(leftover + "=" * (-len(leftover) % 4)))
+
+    def _decode_quoted_printable(self, text: str) -> None:
+        start = 0
+        while start < len(text):
+            stop = text.rfind("\n", start, start + DECODE_CHUNK_SIZE) + 1
+            if stop <= start:
+                stop = min(start + DECODE_CHUNK_SIZE, len(text))
+            self.write(binascii.a2b_qp(text[start:stop].encode("ascii")))
+            start = stop
+
+    def write(self, data: bytes) -> None:
+        if not self._spilled and self.size + len(data) > self.spill_threshold:
+            spooled = tempfile.TemporaryFile()
+            spooled.write(self._file.getbuffer())
+            self._file = spooled
+            self._spilled = True
+        self._file.write(data)
+        self.size += len(data)
+
+    @property
+    def spilled(self) -> bool:
+        return self._spilled
+
+    def getbuffer(self) -> memoryview:
+        if not self._spilled:
+            return self._file.getbuffer()
+        if self.size == 0:
+            return memoryview(b"")
+        if self._mmap is None:
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)
+
+    def read(self) -> bytes:
+        return bytes(self.getbuffer())
+
+    def write_to(self, fileobj: BinaryIO) -> None:
+        if not self._spilled:
+            fileobj.write(self._file.getbuffer())
+            return
+        self._file.seek(0)
+        shutil.copyfileobj(self._file, fileobj)
+
+    def close(self) -> None:
+        # a memoryview from getbuffer may still be alive (e.g. one a sink handed to an upload), closing
+        # the buffer under it raises BufferError; it is then dropped and freed along with its last view
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass
+            self._mmap = None
+        try:
+            self._file.close()
+        except BufferError:
+            pass
+
 
 @dataclasses.dataclass(repr=False)
 class Attachment:
     name: str
     content_type: str
-    content: bytes
+    payload: Union[bytes, Payload]
+    released: bool = False
+
+    @property
+    def content(self) -> bytes:
+        # a copy for spilled payloads, prefer getbuffer or write_to for large attachments
+        if isinstance(self.payload, Payload):
+            return self.payload.read()
+        return self.payload
+
+    @property
+    def size(self) -> int:
+        if isinstance(self.payload, Payload):
+            return self.payload.size
+        return len(self.payload)
+
+    def getbuffer(self) -> memoryview:
+        if isinstance(self.payload, Payload):
+            return self.payload.getbuffer()
+        return memoryview(self.payload)
+
+    def write_to(self, fileobj: BinaryIO) -> None:
+        if isinstance(self.payload, Payload):
+            self.payload.write_to(fileobj)
+        else:
+            fileobj.write(self.payload)
+
+    @functools.cached_property
+    def sha256(self) -> str:
+        return hashlib.sha256(self.getbuffer()).hexdigest()
+
+    def release(self) -> None:
+        # drops the bytes once a sink has written them, name and content type stay available
+        if isinstance(self.payload, Payload):
+            self.payload.close()
+        self.payload = b""
+        self.released = True
 
 
 class EMLExtractor:
-    def __init__(self, mail: Mail, filename: Optional[str] = None):
+    def __init__(
+        self,
+        mail: Mail,
+        filename: Optional[str] = None,
+        renderer: Optional[BodyRenderer] = None,
+        text_renderer: Optional[FitzTextRenderer] = None,
+        render_body: bool = True,
+        spill_threshold: int = SPILL_THRESHOLD,
+        sink: Optional[AttachmentSink] = None,
+    ):
         self.mail: Mail = mail
+        # the body pdf is rendered when body_document is first read or by render_bodies, never if render_body is False
+        self.render_body = render_body
+        self.spill_threshold = spill_threshold
+        # with a sink every attachment is written as soon as it is decoded and released afterwards,
+        # documents then only describe what was written
+        self.sink = sink
+        # html bodies go through renderer (pdfkit unless a pool is passed), plain text never leaves the process
+        self.renderer: BodyRenderer = renderer or PdfkitRenderer()
+        self.text_renderer: FitzTextRenderer = text_renderer or FitzTextRenderer()
 
         #
         self.email_labels = self.mail['X-Gmail-Labels']
@@ -34,25 +211,51 @@ class EMLExtractor:
         self.email_subject = self.mail['Subject']
         #
 
-        self.body_document: Optional[Attachment] = None
-        self.documents: list[Attachment] = []
+        self._body_document: Optional[Attachment] = None
+        self._body_rendered = False
+        # attachments and nested extractors in mail order, flattened by documents once the body is resolved
+        self._document_entries: list[Union[Attachment, "EMLExtractor"]] = []
         self.html: Optional[bs4.BeautifulSoup] = None  # decoded to bytes in case of quoted-printable
         self.plain_text: Optional[str] = None
         self.filename: Optional[str] = filename
 
-        self._nested_body_documents: list[Attachment] = []
+        self._nested_extractors: list[EMLExtractor] = []
         self._images: list[Mail] = []
+        self._images_by_cid: dict[str, Mail] = {}
+        self._images_by_filename: dict[str, Mail] = {}
         self._images_found_in_html: set[Mail] = set()
+        self._images_in_documents: set[Mail] = set()
+        self._html_image_matches: list[tuple[bs4.Tag, str, Optional[Mail]]] = []
         self._methods_dict: dict[str, Callable[[Mail], None]] = self._create_methods_dict()
 
         if filename:
             logger.info(f"Extracting {filename}")
 
         self._parse_mail(mail)
-        self._generate_body_doc()
-        self._concatenate_body_docs()
+        self._match_html_images()
         self._put_unused_images_in_documents()
 
+    @property
+    def body_document(self) -> Optional[Attachment]:
+        if not self._body_rendered:
+            self._body_rendered = True
+            if self.render_body:
+                self._generate_body_doc()
+                self._concatenate_body_docs()
+        return self._body_document
+
+    @property
+    def documents(self) -> list[Attachment]:
+        # never renders the body. A failed html render turns the images it would have shown into documents,
+        # in this message or a nested one; they are listed once body_document or render_bodies has run
+        documents = []
+        for entry in self._document_entries:
+            if isinstance(entry, EMLExtractor):
+                documents.extend(entry.documents)
+            else:
+                documents.append(entry)
+        return documents
+
     def _create_methods_dict(self) -> dict[str, Callable[[Mail], None]]:
         # a sprinkle of magic
         dict_ = {}
@@ -78,11 +281,10 @@ class EMLExtractor:
 
         method(mail)
 
-    def _generate_body_doc(self) -> None:
+    def _match_html_images(self) -> None:
+        # decides which images the html uses, cheap enough to run even when the body is never rendered
         if not self.html:
-            return self._generate_plaintext_body_doc()  # fallback to plaintext
-
-        logger.info("Generating pdf from html")
+            return
 
         body = self.html
 
@@ -90,16 +292,16 @@ class EMLExtractor:
         img_tags = body("img")  # somebody put a background image on the body, not handling it crashes pdfkit
 
         # sometimes the inline images get transformed into es$correspondimage001.jpg attachments...
-        corresponding_images = [img for img in self._images if img.get_filename().startswith("es$correspond_image")]
+        corresponding_images = [
+            img for img in self._images if (img.get_filename() or "").startswith("es$correspond_image")
+        ]
         if corresponding_images and len(corresponding_images) == len(img_tags):
             logger.info("Images found as es$correspond_image attachments")
             corresponding_images = sorted(
                 corresponding_images, key=lambda x: int(re.sub("[^0-9]", "", x.get_filename()))
             )
             for mail, img_tag in zip(corresponding_images, img_tags):
-                img_type = mail.get_content_type()
-                img_bytes = mail.get_payload()
-                img_tag.attrs["src"] = f"data:{img_type};base64,{img_bytes}"
+                self._html_image_matches.append((img_tag, "src", mail))
                 self._images_found_in_html.add(mail)
             img_tags = []
 
@@ -116,13 +318,35 @@ class EMLExtractor:
 
             # get img mail
             cid = img_tag.attrs[attr_name]
-            img_mail = self._find_image_for_cid(cid)
+            self._html_image_matches.append((img_tag, attr_name, self._find_image_for_cid(cid)))
 
+    def _generate_body_doc(self) -> None:
+        html = self._body_html()
+        if html is None:
+            return self._generate_plaintext_body_doc()  # fallback to plaintext
+
+        # convert to pdf
+        try:
+            pdf = self.renderer.render(html)
+        except OSError as e:
+            logger.error(f"{type(self.renderer).__name__} crashed :(", exc_info=e)
+            return self._html_render_failed()
+        self._set_html_body_doc(pdf)
+
+    def _body_html(self) -> Optional[str]:
+        # the html to render, with images inlined and the email header on top; None without an html body.
+        # it edits the parsed html in place, so it is called once per extractor
+        if not self.html:
+            return None
+
+        logger.info("Generating pdf from html")
+
+        body = self.html
+
+        for img_tag, attr_name, img_mail in self._html_image_matches:
             if img_mail:
                 # substitute cid for img
-                img_type = img_mail.get_content_type()
-                img_bytes = img_mail.get_payload()
-                img_tag.attrs[attr_name] = f"data:{img_type};base64,{img_bytes}"
+                img_tag.attrs[attr_name] = self._image_data_uri(img_mail)
             elif "http" not in img_tag.attrs[attr_name]:  # some weird links can crash pdfkit
                 # remove non-http links
                 logger.info(f"Removing img tag {img_tag}")
@@ -166,66 +390,76 @@ class EMLExtractor:
         header.string = self.filename
         body.html.body.insert(0, header)
 
+        return str(body)
 
+    def _html_render_failed(self) -> None:
+        self._images_found_in_html = set()  # reset html replaced images
+        self._put_unused_images_in_documents()  # they aren't shown anywhere now
+        return self._generate_plaintext_body_doc()  # fallback to plaintext
 
-        # convert to pdf
-        try:
-            pdf = pdfkit.from_string(str(body))
-        except OSError as e:
-            logger.error("pdfkit crashed :(", exc_info=e)
-            self._images_found_in_html = set()  # reset html replaced images
-            return self._generate_plaintext_body_doc()  # fallback to plaintext
-
-        self.body_document = Attachment(
+    def _set_html_body_doc(self, pdf: bytes) -> None:
+        self._body_document = Attachment(
             name="email_body.pdf",
             content_type="application/pdf",
-            content=pdf,
+            payload=pdf,
         )
 
+    @staticmethod
+    def _image_data_uri(img_mail: Mail) -> str:
+        # base64 transfer encoded images already carry the data uri payload, don't decode and re-encode them
+        if str(img_mail.get("Content-Transfer-Encoding", "")).strip().lower() == "base64":
+            img_b64 = img_mail.get_payload()
+        else:
+            img_b64 = base64.b64encode(img_mail.get_payload(decode=True) or b"").decode("ascii")
+        return "".join(("data:", img_mail.get_content_type(), ";base64,", img_b64))
+
     def _generate_plaintext_body_doc(self) -> None:
         if not self.plain_text:
             return
 
         logger.info("Generating pdf from plain text")
 
-        # TODO make plain text render prettier, unicode characters aren't rendered properly
-        html = "<p>" + self.plain_text.replace("\n", "<br>") + "</p>"
-        body = bs4.BeautifulSoup(html, "html.parser")
         try:
-            pdf = pdfkit.from_string(str(body))
+            pdf = self.text_renderer.render_text(self.plain_text)
         except OSError as e:
-            logger.error("pdfkit crashed on plain text O.o", exc_info=e)
+            logger.error("PyMuPDF crashed on plain text O.o", exc_info=e)
             return
 
-        self.body_document = Attachment(
+        self._body_document = Attachment(
             name="email_body.pdf",
             content_type="application/pdf",
-            content=pdf,
+            payload=pdf,
         )
 
     def _concatenate_body_docs(self):
-        if self._nested_body_documents:
+        nested_body_documents = [e.body_document for e in self._nested_extractors if e.body_document]
+        if nested_body_documents:
             logger.info("Merging body document with nested emails'")
-            main_doc = fitz.open(self.body_document.name, self.body_document.content)
-            for nested_body_document in self._nested_body_documents:
+            if self._body_document:
+                main_doc = fitz.open(self._body_document.name, self._body_document.content)
+            else:
+                main_doc = fitz.open()
+            for nested_body_document in nested_body_documents:
                 other_doc = fitz.open(nested_body_document.name, nested_body_document.content)
                 main_doc.insert_pdf(other_doc)
-            self.body_document = Attachment(
+            self._body_document = Attachment(
                 name="mailbody.pdf",
                 content_type="application/pdf",
-                content=main_doc.tobytes(),
+                payload=main_doc.tobytes(),
             )
 
     def _put_unused_images_in_documents(self) -> None:
         for mail in self._images:
             if (
                 mail not in self._images_found_in_html
+                and mail not in self._images_in_documents
                 and mail.is_attachment()
                 and mail.get_content_disposition() != "inline"
                 # TODO remove imagemagick requirement
                 # and not self._similar_image_is_embedded(mail)
             ):
                 logger.info(f"{mail.get_filename()} not found in html, adding to documents")
+                self._images_in_documents.add(mail)
                 self.__application(mail)
 
     def _similar_image_is_embedded(self, image_mail: Mail) -> bool:
@@ -252,24 +486,24 @@ class EMLExtractor:
         return False
 
     def _find_image_for_cid(self, tag_cid: str) -> Optional[Mail]:
-        def image_matches_tag(mail: Mail) -> bool:
-            if tag_cid.startswith("cid:") and "Content-ID" in mail:
-                cid = mail["Content-ID"]
-                cid = cid.strip("<").strip(">")
-                if cid == tag_cid[4:]:
-                    return True
-            if mail.get_filename() in tag_cid:
+        mail = None
+        if tag_cid.startswith("cid:"):
+            mail = self._images_by_cid.get(tag_cid[4:])
+        if mail is None:
+            mail = self._find_image_for_filename(tag_cid)
+            if mail is not None:
                 logger.info("Didn't match image by CID, but did it by filename anyway")
-                return True
-            return False
-
-        iterator = (mail for mail in self._images if image_matches_tag(mail))
-        try:
-            mail = next(iterator)
+        if mail is not None:
             self._images_found_in_html.add(mail)
-            return mail
-        except StopIteration:
-            return None
+        return mail
+
+    def _find_image_for_filename(self, tag_src: str) -> Optional[Mail]:
+        if tag_src in self._images_by_filename:
+            return self._images_by_filename[tag_src]
+        for part in SRC_SEPARATORS.split(tag_src):
+            if part in self._images_by_filename:
+                return self._images_by_filename[part]
+        return None
 
     def __multipart(self, mail: Mail) -> None:
         for child_mail in mail.get_payload():
@@ -301,30 +535,45 @@ class EMLExtractor:
 
     def __image(self, mail: Mail) -> None:
         self._images.append(mail)
+        # first image wins on duplicate keys, same as the list scan this replaces
+        if "Content-ID" in mail:
+            cid = str(mail["Content-ID"]).strip().strip("<").strip(">")
+            self._images_by_cid.setdefault(cid, mail)
+        filename = mail.get_filename()
+        if filename:
+            self._images_by_filename.setdefault(filename, mail)
 
     def __application(self, mail: Mail) -> None:
-        payload_bytes = mail.get_payload(decode=True)
-        if not isinstance(payload_bytes, bytes):
-            logger.debug(f"Unexpected attachment payload type: {payload_bytes}")
+        payload = Payload.from_mail(mail, self.spill_threshold)
+        if payload is None:
+            logger.debug(f"Unexpected attachment payload type: {type(mail.get_payload())}")
             return
 
-        self.documents.append(
-            Attachment(
-                name=mail.get_filename(),
-                content_type=mail.get_content_type(),
-                content=payload_bytes,
-            )
+        attachment = Attachment(
+            name=mail.get_filename(),
+            content_type=mail.get_content_type(),
+            payload=payload,
         )
+        self._document_entries.append(attachment)
+        if self.sink:
+            self.sink.consume(attachment)
 
     def __message_rfc822(self, mail: Mail) -> None:
         # this is a nested email
 
         # TODO check if this always has only one element?
         for part in mail.get_payload():
-            extractor = EMLExtractor(part)
-            self.documents.extend(extractor.documents)
-            if extractor.body_document:
-                self._nested_body_documents.append(extractor.body_document)
+            extractor = EMLExtractor(
+                part,
+                renderer=self.renderer,
+                text_renderer=self.text_renderer,
+                render_body=self.render_body,
+                spill_threshold=self.spill_threshold,
+                sink=self.sink,
+            )
+            # its documents are listed through it, they may still grow when its body is rendered
+            self._document_entries.append(extractor)
+            self._nested_extractors.append(extractor)
 
         # alternatively, you could just call self._parse_mail(mail) on the nested mail
         # if you do so, make sure to adjust how the html and plain text are concatenated
@@ -335,27 +584,71 @@ class EMLExtractor:
         # self.__multipart_related(mail)
 
 
+def render_bodies(extractors: Sequence[EMLExtractor], renderer: Optional[BodyRenderer] = None) -> None:
+    """Renders the body documents of many extractors, all their html bodies in one render_batch call.
+
+    With a WkhtmltopdfPool that is one wkhtmltopdf run per pool slot for the whole batch instead
+    of one per email. Nested messages are rendered along and merged into their parents like
+    body_document does; failed html renders fall back to plain text. Extractors whose body was
+    read already are left alone.
+
+    Args:
+        extractors (list): The extractors, e.g. the last few dozen emails of a mailbox.
+        renderer (BodyRenderer): Renders the html bodies, the first extractor's renderer if not passed.
+    """
+    pending: list[EMLExtractor] = []
+
+    def collect(extractor: EMLExtractor) -> None:
+        # nested messages before the message holding them, so they are rendered when it merges them
+        for nested in extractor._nested_extractors:
+            collect(nested)
+        if extractor.render_body and not extractor._body_rendered:
+            pending.append(extractor)
+
+    for extractor in extractors:
+        collect(extractor)
+
+    htmls = {}
+    for extractor in pending:
+        html = extractor._body_html()
+        if html is not None:
+            htmls[id(extractor)] = html
+    if htmls:
+        renderer = renderer or pending[0].renderer
+        pdfs = dict(zip(htmls, renderer.render_batch(list(htmls.values()))))
+    else:
+        pdfs = {}
+
+    for extractor in pending:
+        extractor._body_rendered = True
+        if id(extractor) not in htmls:
+            extractor._generate_plaintext_body_doc()
+        elif pdfs.get(id(extractor)) is None:
+            logger.error(f"{type(renderer).__name__} failed to render the body of {extractor.filename}")
+            extractor._html_render_failed()
+        else:
+            extractor._set_html_body_doc(pdfs[id(extractor)])
+        extractor._concatenate_body_docs()
+
+
 if __name__ == "__main__":
     from email import policy
     from email.parser import BytesParser
+    from attachment_sinks import BackgroundSink, DirectorySink
+    from attachment_store import AttachmentStore
 
     fn = "/Users/todorlubenov/cytora_data/bulk_datas/test/176. EXTERNAL Motor Fleet Enquiry for Bakro International Transport Ltd - Haulage Fleet and cars.msg.eml"
 
+    dirname = f'/Users/todorlubenov/cytora_data/bulk_datas/test/my_pdf_renders/{fn.split("/")[-1]}'
+    store = AttachmentStore('/Users/todorlubenov/cytora_data/bulk_datas/test/my_pdf_renders_blobs')
+
     with open(fn, "rb") as f:
         msg = BytesParser(policy=policy.default).parse(f)
-    extractor = EMLExtractor(msg, fn.split("/")[-1])
-
-    attachments = extractor.documents
-    if extractor.body_document:
-        attachments.append(extractor.body_document)
-
-    import os
-
-    dirname = f'/Users/todorlubenov/cytora_data/bulk_datas/test/my_pdf_renders/{fn.split("/")[-1]}'
-    os.makedirs(dirname, exist_ok=True)
-    for attachment in attachments:
-        with open(f"{dirname}/{attachment.name}", "wb") as f:
-            f.write(attachment.content)
+    # attachments are written by a background thread while the body is rendered
+    with BackgroundSink(DirectorySink(dirname, store)) as sink:
+        extractor = EMLExtractor(msg, fn.split("/")[-1], sink=sink)
+        if extractor.body_document:
+            sink.consume(extractor.body_document)
 
 
 # if __name__ == "__main__":
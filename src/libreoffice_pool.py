@@ -0,0 +1,350 @@
+import os
+import queue
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xmlrpc.client
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import structlog
+
+logger = structlog.getLogger(__name__)
+
+
+OFFICE_EXTENSIONS = ('.doc', '.docx', '.odt')
+
+PDF_FILTERS = {
+    '.doc': 'writer_pdf_Export',
+    '.docx': 'writer_pdf_Export',
+    '.odt': 'writer_pdf_Export',
+    '.rtf': 'writer_pdf_Export',
+    '.xls': 'calc_pdf_Export',
+    '.xlsx': 'calc_pdf_Export',
+    '.ods': 'calc_pdf_Export',
+    '.ppt': 'impress_pdf_Export',
+    '.pptx': 'impress_pdf_Export',
+    '.odp': 'impress_pdf_Export',
+}
+
+# run under LibreOffice's python by every worker, see the module's docstring
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libreoffice_server.py')
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _pdf_path(in_file: str, out_file: Optional[str] = None) -> str:
+    if out_file:
+        return f'{os.path.splitext(out_file)[0]}.pdf'
+    return f'{os.path.splitext(in_file)[0]}.pdf'
+
+
+def office_python(soffice: str) -> Optional[str]:
+    """A python that can import uno: the one LibreOffice ships next to soffice, else this one or a python3
+    on the PATH (distribution builds use the system python with python3-uno). None when there is none.
+    """
+    program = os.path.dirname(os.path.realpath(shutil.which(soffice) or soffice))
+    candidates = [
+        os.path.join(program, 'python'),
+        os.path.join(program, 'python.exe'),
+        os.path.join(program, os.pardir, 'Resources', 'python'),  # macOS, LibreOffice.app/Contents/MacOS/soffice
+        sys.executable,
+        shutil.which('python3'),
+    ]
+    for python in candidates:
+        if not python or not os.path.isfile(python):
+            continue
+        try:
+            subprocess.run([python, '-c', 'import uno'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           timeout=30, check=True)
+        except (OSError, subprocess.SubprocessError):
+            continue
+        return python
+    return None
+
+
+class _TimeoutTransport(xmlrpc.client.Transport):
+    def __init__(self, timeout: Optional[float]):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        conn = super().make_connection(host)
+        conn.timeout = self.timeout
+        return conn
+
+
+class LibreOfficeWorker:
+    """One headless LibreOffice instance with its own user profile.
+
+    The pipeline's python can't import ``uno`` (LibreOffice bundles its own interpreter), so with a
+    ``python`` that can (see office_python) the worker starts libreoffice_server.py under it, which
+    keeps one soffice listening and converts over XML-RPC; the cold start is paid once per worker.
+    Without one each conversion falls back to a ``soffice --convert-to`` call, still with the
+    worker's own profile so that several conversions can run side by side.
+    """
+
+    def __init__(self, soffice: str, timeout: int = 120, startup_timeout: int = 60, python: Optional[str] = None):
+        self.soffice = soffice
+        self.timeout = timeout
+        self.startup_timeout = startup_timeout
+        self.python = python
+        self.profile_dir = tempfile.mkdtemp(prefix='lo_profile_')
+        self.process: Optional[subprocess.Popen] = None
+        self.server: Optional[xmlrpc.client.ServerProxy] = None
+        self.port: Optional[int] = None
+        self.conversions = 0
+        self.restarts = 0
+
+    @property
+    def profile_uri(self) -> str:
+        return Path(self.profile_dir).as_uri()
+
+    def start(self) -> None:
+        if self.python is None:
+            return
+
+        self.port = _free_port()
+        # a session of its own, so stop takes the server's soffice down with it
+        self.process = subprocess.Popen([
+            self.python,
+            SERVER_SCRIPT,
+            '--soffice', self.soffice,
+            '--profile', self.profile_uri,
+            '--uno-port', str(_free_port()),
+            '--port', str(self.port),
+            '--startup-timeout', str(self.startup_timeout),
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=os.name == 'posix')
+
+        deadline = time.monotonic() + self.startup_timeout
+        while True:
+            server = xmlrpc.client.ServerProxy(f'http://127.0.0.1:{self.port}', allow_none=True,
+                                               transport=_TimeoutTransport(self.startup_timeout))
+            try:
+                server.ping()
+                break
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError(f'LibreOffice server on port {self.port} did not start')
+                time.sleep(0.25)
+        self.server = xmlrpc.client.ServerProxy(f'http://127.0.0.1:{self.port}', allow_none=True,
+                                                transport=_TimeoutTransport(self.timeout))
+        logger.info(f'LibreOffice worker listening on port {self.port}')
+
+    def stop(self) -> None:
+        self.server = None
+        if self.process is None:
+            return
+        try:
+            if os.name == 'posix':
+                os.killpg(self.process.pid, signal.SIGKILL)
+            else:
+                self.process.kill()
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+        self.process = None
+
+    def restart(self) -> None:
+        self.restarts += 1
+        logger.warning(f'Restarting LibreOffice worker on port {self.port}')
+        self.stop()
+        self.start()
+
+    def is_alive(self) -> bool:
+        if self.python is None:
+            return True
+        return self.process is not None and self.process.poll() is None
+
+    def close(self) -> None:
+        self.stop()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+    def convert(self, in_file: str, out_file: Optional[str] = None) -> str:
+        """Converts one file to PDF, restarting the instance first if it died.
+
+        Args:
+            in_file (str): The path to the input file.
+            out_file (str): The path to the output file, next to in_file if not passed.
+
+        Returns:
+            str: The path of the written PDF.
+        """
+        if not self.is_alive():
+            self.restart()
+
+        pdf_file = _pdf_path(in_file, out_file)
+        if self.python is None:
+            self._convert_cli(in_file, pdf_file)
+        else:
+            self._convert_server(in_file, pdf_file)
+        self.conversions += 1
+        return pdf_file
+
+    def _convert_server(self, in_file: str, pdf_file: str) -> None:
+        ext = os.path.splitext(in_file)[1].lower()
+        try:
+            self.server.convert(os.path.abspath(in_file), os.path.abspath(pdf_file),
+                                PDF_FILTERS.get(ext, 'writer_pdf_Export'))
+        except socket.timeout:
+            # a hung load/store can't be interrupted, the instance is killed and started again
+            self.restart()
+            raise TimeoutError(f'LibreOffice conversion of {in_file} took more than {self.timeout} seconds')
+        except xmlrpc.client.Fault as ex:
+            self.restart()
+            raise RuntimeError(f'LibreOffice could not convert {in_file}: {ex.faultString}') from None
+        except Exception:
+            self.restart()
+            raise
+
+    def _convert_cli(self, in_file: str, pdf_file: str) -> None:
+        outdir = tempfile.mkdtemp(prefix='lo_out_')
+        try:
+            subprocess.run([
+                self.soffice,
+                f'-env:UserInstallation={self.profile_uri}',
+                '--headless',
+                '--convert-to',
+                'pdf',
+                '--outdir',
+                outdir,
+                in_file
+            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=self.timeout, check=True)
+            shutil.move(os.path.join(outdir, f'{Path(in_file).stem}.pdf'), pdf_file)
+        finally:
+            shutil.rmtree(outdir, ignore_errors=True)
+
+
+class LibreOfficePool:
+    """A fixed number of LibreOfficeWorker instances fed from a shared queue.
+
+    Every worker runs in its own thread and owns one LibreOffice instance for the pool's lifetime.
+    The instances are driven through libreoffice_server.py under ``python``, LibreOffice's own
+    python found next to soffice when not passed (see office_python).
+    Use ``submit`` for a Future, ``convert`` for a blocking call and ``convert_directory`` to
+    convert a whole folder in one call.
+    """
+
+    def __init__(self, size: int = 2, soffice: str = None, timeout: int = 120, python: str = None):
+        self.size = size
+        self.soffice = soffice or shutil.which('soffice') or 'soffice'
+        self.timeout = timeout
+        self.python = python
+        self._queue: queue.Queue = queue.Queue()
+        self._workers: List[LibreOfficeWorker] = []
+        self._threads: List[threading.Thread] = []
+        self._started = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            if self.python is None:
+                self.python = office_python(self.soffice)
+            for i in range(self.size):
+                worker = LibreOfficeWorker(self.soffice, self.timeout, python=self.python)
+                thread = threading.Thread(target=self._run, args=(worker,), name=f'libreoffice-{i}', daemon=True)
+                self._workers.append(worker)
+                self._threads.append(thread)
+                thread.start()
+            self._started = True
+        if self.python is None:
+            logger.warning('no python that can import uno was found next to soffice, every LibreOffice '
+                           'conversion cold starts soffice; pass python to keep the instances warm')
+
+    def _run(self, worker: LibreOfficeWorker) -> None:
+        try:
+            worker.start()
+        except Exception as ex:
+            logger.error('LibreOffice worker failed to start', exc_info=ex)
+
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            in_file, out_file, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(worker.convert(in_file, out_file))
+            except Exception as ex:
+                future.set_exception(ex)
+        worker.close()
+
+    def submit(self, in_file: str, out_file: Optional[str] = None) -> Future:
+        self.start()
+        future = Future()
+        self._queue.put((in_file, out_file, future))
+        return future
+
+    def convert(self, in_file: str, out_file: Optional[str] = None) -> str:
+        return self.submit(in_file, out_file).result()
+
+    def convert_directory(self, in_dir: str, out_dir: Optional[str] = None,
+                          extensions=OFFICE_EXTENSIONS) -> Dict:
+        """Converts every office file under a folder.
+
+        Args:
+            in_dir (str): The folder walked for files with one of the extensions.
+            out_dir (str): Where the PDFs are written, mirroring in_dir; next to the sources if not passed.
+            extensions (tuple): The lower case extensions to convert.
+
+        Returns:
+            dict: The PDF path, or the exception, per input path.
+        """
+        futures = {}
+        for root, _, files in os.walk(in_dir):
+            for file in files:
+                if os.path.splitext(file)[1].lower() not in extensions:
+                    continue
+                in_file = os.path.join(root, file)
+                out_file = None
+                if out_dir:
+                    out_file = os.path.join(out_dir, os.path.relpath(in_file, in_dir))
+                    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+                futures[in_file] = self.submit(in_file, out_file)
+
+        results = {}
+        for in_file, future in futures.items():
+            try:
+                results[in_file] = future.result()
+            except Exception as ex:
+                results[in_file] = ex
+        return results
+
+    def stats(self) -> Dict:
+        return {
+            'workers': self.size,
+            'conversions': sum(w.conversions for w in self._workers),
+            'restarts': sum(w.restarts for w in self._workers),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._started:
+                return
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._workers, self._threads = [], []
+            self._started = False
@@ -0,0 +1,104 @@
+"""Converts documents to PDF through one headless LibreOffice instance, served over XML-RPC.
+
+Run with the python that ships with LibreOffice (or a system python with python3-uno), the only
+interpreters that can import ``uno``. libreoffice_pool starts one of these per worker and talks
+to it from the pipeline's own python, so soffice's cold start is paid once per worker:
+
+    <libreoffice>/program/python libreoffice_server.py --soffice soffice \
+        --profile file:///tmp/lo_profile --uno-port 2002 --port 2003
+
+Only the standard library and uno are imported here, LibreOffice's python has nothing else.
+"""
+import argparse
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+from xmlrpc.server import SimpleXMLRPCServer
+
+import uno
+
+
+def _uno_props(**kwargs):
+    props = []
+    for name, value in kwargs.items():
+        prop = uno.createUnoStruct('com.sun.star.beans.PropertyValue')
+        prop.Name = name
+        prop.Value = value
+        props.append(prop)
+    return tuple(props)
+
+
+def connect(process, uno_port, startup_timeout):
+    """Waits for the soffice listener on uno_port and returns its Desktop."""
+    local_ctx = uno.getComponentContext()
+    resolver = local_ctx.ServiceManager.createInstanceWithContext('com.sun.star.bridge.UnoUrlResolver', local_ctx)
+    deadline = time.monotonic() + startup_timeout
+    while True:
+        try:
+            ctx = resolver.resolve(f'uno:socket,host=127.0.0.1,port={uno_port};urp;StarOffice.ComponentContext')
+            break
+        except Exception:
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f'LibreOffice listener on port {uno_port} did not start')
+            time.sleep(0.25)
+    return ctx.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', ctx)
+
+
+class Converter:
+    """The XML-RPC methods, called one at a time (SimpleXMLRPCServer serves requests in turn)."""
+
+    def __init__(self, desktop):
+        self.desktop = desktop
+
+    def ping(self):
+        return True
+
+    def convert(self, in_file, pdf_file, filter_name):
+        doc = self.desktop.loadComponentFromURL(Path(in_file).as_uri(), '_blank', 0, _uno_props(Hidden=True))
+        if doc is None:
+            raise RuntimeError(f'LibreOffice could not load {in_file}')
+        try:
+            doc.storeToURL(Path(pdf_file).as_uri(), _uno_props(FilterName=filter_name))
+        finally:
+            doc.close(True)
+        return pdf_file
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--soffice', default='soffice')
+    parser.add_argument('--profile', required=True, help='file URI of the user profile')
+    parser.add_argument('--uno-port', type=int, required=True)
+    parser.add_argument('--port', type=int, required=True, help='XML-RPC port, on 127.0.0.1')
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    args = parser.parse_args(argv)
+
+    # the pool stops a server with SIGTERM (or kills its process group), soffice goes with it
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    process = subprocess.Popen([
+        args.soffice,
+        '--headless',
+        '--invisible',
+        '--nologo',
+        '--nodefault',
+        '--norestore',
+        '--nolockcheck',
+        f'-env:UserInstallation={args.profile}',
+        f'--accept=socket,host=127.0.0.1,port={args.uno_port};urp;StarOffice.ComponentContext',
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        desktop = connect(process, args.uno_port, args.startup_timeout)
+        server = SimpleXMLRPCServer(('127.0.0.1', args.port), logRequests=False, allow_none=True)
+        server.register_instance(Converter(desktop))
+        print(f'LibreOffice server listening on port {args.port}', flush=True)
+        server.serve_forever()
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Sequence
+
+from botocore.exceptions import ClientError
+
+CACHE_FILE_NAME = 'ocr_cache.sqlite'
+
+
+def cache_key(etag: str, api: str, features: Sequence[str] = ()) -> str:
+    """The cache key of a page: its content hash plus the Textract API and feature types it was sent with."""
+    return hashlib.sha256(f"{etag}|{api}|{','.join(sorted(features))}".encode()).hexdigest()
+
+
+class CachedPage:
+    """One page's cache lookup, see OcrCache.page.
+
+    ``response`` is the cached Textract response and ``source`` where it came from ('local' or 's3'),
+    both None on a miss. put_result stores the response and records it.
+    """
+
+    def __init__(self, cache: 'OcrCache', key: str, etag: str, api: str, features: Sequence[str]):
+        self.cache = cache
+        self.key = key
+        self.etag = etag
+        self.api = api
+        self.features = features
+        self.response: Optional[Dict] = None
+        self.source: Optional[str] = None
+        self.result_bucket: Optional[str] = None
+        self.result_key: Optional[str] = None
+
+    @property
+    def hit(self) -> bool:
+        return self.response is not None
+
+    def record(self, result_bucket: str, result_key: str) -> None:
+        self.cache.store(self.key, self.etag, self.api, self.features, result_bucket, result_key)
+
+
+class OcrCache:
+    """Remembers which Textract result belongs to which page content, so a page is OCR'd once.
+
+    A page is identified by its S3 ETag (the MD5 of the PNG for the single part uploads ``aws s3
+    sync`` does), which comes from a HEAD request, so the page is never downloaded for the lookup.
+    The local SQLite index maps the ETag, API and feature types to the S3 key the response was
+    stored under. When ``check_s3`` is set, a page missing from the index is also looked up at its
+    own result key, which picks up results written before the cache existed.
+
+    Identical pages in duplicated attachments are looked up by several run_pages threads at once,
+    so only the first of them calls Textract and the others wait for its result.
+
+    Args:
+        path (str): The SQLite index file.
+        check_s3 (bool): Also trust results already under the page's own result key.
+    """
+
+    def __init__(self, path: str = CACHE_FILE_NAME, check_s3: bool = False):
+        self.path = path
+        self.check_s3 = check_s3
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS ocr_results ('
+            'cache_key TEXT PRIMARY KEY, etag TEXT, api TEXT, features TEXT, '
+            'result_bucket TEXT, result_key TEXT, created_at REAL)'
+        )
+        self.conn.commit()
+        self.counts = {'lookups': 0, 'local_hits': 0, 's3_hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, threading.Event] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def lookup(self, key: str) -> Optional[tuple]:
+        with self._lock:
+            return self.conn.execute(
+                'SELECT result_bucket, result_key FROM ocr_results WHERE cache_key = ?', (key,)
+            ).fetchone()
+
+    def store(self, key: str, etag: str, api: str, features: Sequence[str], result_bucket: str,
+              result_key: str) -> None:
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO ocr_results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, etag, api, ','.join(sorted(features)), result_bucket, result_key, time.time())
+            )
+            self.conn.commit()
+
+    @contextmanager
+    def page(self, s3_client, bucket: str, document: str, api: str, features: Sequence[str],
+             result_key: str) -> Iterator[CachedPage]:
+        """Looks a page up, to be used as ``with cache.page(...) as cached:``.
+
+        While the block is running, other threads looking up the same content wait for it, so call
+        Textract and store the result (put_result) inside it.
+
+        Args:
+            s3_client: The S3 client, for the HEAD of the page and reading cached responses.
+            bucket (str): The page's bucket.
+            document (str): The page's S3 key.
+            api (str): The Textract API, e.g. 'detect_document_text'.
+            features (list): The FeatureTypes the API is called with.
+            result_key (str): The page's own result key, checked when check_s3 is set.
+        """
+        etag = s3_client.head_object(Bucket=bucket, Key=document)['ETag'].strip('"')
+        key = cache_key(etag, api, features)
+        cached = CachedPage(self, key, etag, api, features)
+
+        while True:
+            with self._lock:
+                other = self._in_flight.get(key)
+                if other is None:
+                    event = self._in_flight[key] = threading.Event()
+                    break
+            other.wait()
+
+        try:
+            self._fetch(s3_client, cached, bucket, result_key)
+            self._count(cached)
+            yield cached
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            event.set()
+
+    def _fetch(self, s3_client, cached: CachedPage, bucket: str, result_key: str) -> None:
+        row = self.lookup(cached.key)
+        if row is not None:
+            try:
+                obj = s3_client.get_object(Bucket=row[0], Key=row[1])
+                cached.response = json.loads(obj['Body'].read())
+                cached.source = 'local'
+                cached.result_bucket, cached.result_key = row
+                return
+            except ClientError:
+                pass  # the result was deleted, OCR the page again
+
+        if self.check_s3:
+            try:
+                obj = s3_client.get_object(Bucket=bucket, Key=result_key)
+            except ClientError:
+                return
+            # results stored with the cache carry the page's ETag, older ones are trusted as they are
+            source_etag = obj.get('Metadata', {}).get('source-etag')
+            if source_etag is None or source_etag == cached.etag:
+                cached.response = json.loads(obj['Body'].read())
+                cached.source = 's3'
+                cached.result_bucket, cached.result_key = bucket, result_key
+                cached.record(bucket, result_key)
+
+    def _count(self, cached: CachedPage) -> None:
+        with self._lock:
+            self.counts['lookups'] += 1
+            if cached.source == 'local':
+                self.counts['local_hits'] += 1
+            elif cached.source == 's3':
+                self.counts['s3_hits'] += 1
+            else:
+                self.counts['misses'] += 1
+
+    def summary(self) -> Dict:
+        with self._lock:
+            counts = dict(self.counts)
+            counts['entries'] = self.conn.execute('SELECT COUNT(*) FROM ocr_results').fetchone()[0]
+        hits = counts['local_hits'] + counts['s3_hits']
+        counts['hit_rate'] = hits / counts['lookups'] if counts['lookups'] else 0.0
+        return counts
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def put_result(s3_client, bucket: str, key: str, response: Dict, cached: Optional[CachedPage] = None) -> Dict:
+    """Stores a page's Textract response under its result key and records it in the cache.
+
+    A cached response that is already under the key isn't written again, one stored for an
+    identical page elsewhere is copied server side.
+
+    Returns:
+        dict: The S3 response, a bare 200 when nothing had to be written.
+    """
+    if cached is not None and cached.hit and (cached.result_bucket, cached.result_key) == (bucket, key):
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+    if cached is not None and cached.hit:
+        result = s3_client.copy_object(CopySource={'Bucket': cached.result_bucket, 'Key': cached.result_key},
+                                       Bucket=bucket, Key=key)
+    else:
+        metadata = {'source-etag': cached.etag} if cached is not None else {}
+        result = s3_client.put_object(Body=json.dumps(response), Bucket=bucket, Key=key, Metadata=metadata)
+    if cached is not None:
+        cached.record(bucket, key)
+    return result
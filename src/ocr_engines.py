@@ -0,0 +1,246 @@
+import glob
+import json
+import os
+import sys
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import pytesseract
+from PIL import Image
+
+from aws_clients import get_client
+from page_triage import read_page_triage, skipped_triage
+from textract_blocks import words_to_response
+from textract_pipeline import AdaptiveLimiter, call_with_backoff
+
+
+def mean_confidence(response: Dict) -> Optional[float]:
+    """The mean WORD confidence of a response, None when there are no words."""
+    confidences = [b['Confidence'] for b in response['Blocks'] if b['BlockType'] == 'WORD']
+    return sum(confidences) / len(confidences) if confidences else None
+
+
+class OcrEngine(ABC):
+    """Turns page images into Textract shaped responses: PAGE, LINE and WORD blocks with
+    page relative geometry, confidences from 0 to 100 and CHILD relationships.
+
+    Subclasses implement ``recognize``; ``recognize_batch`` maps it over the pages.
+    """
+
+    name = 'ocr'
+    result_folder = 'ocr'
+
+    @abstractmethod
+    def recognize(self, path: str) -> Dict:
+        """OCRs one page image."""
+
+    def recognize_batch(self, paths: Sequence[str]) -> List[Dict]:
+        return [self.recognize(path) for path in paths]
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TextractEngine(OcrEngine):
+    """Sends the page bytes to Textract, ``concurrency`` calls at a time with the throttling backoff of run_pages.
+
+    Args:
+        client: A Textract client, the thread's pooled one from aws_clients when None.
+        features (list): FeatureTypes for analyze_document, detect_document_text is used without them.
+        concurrency (int): The maximum number of calls in flight for recognize_batch.
+    """
+
+    name = 'textract'
+
+    def __init__(self, client=None, features: Optional[Sequence[str]] = None, concurrency: int = 8):
+        self.client = client
+        self.features = list(features) if features else None
+        self.concurrency = concurrency
+        self.result_folder = 'aws_textract_document' if self.features else 'aws_textract_ocr'
+        self._limiter = AdaptiveLimiter(concurrency)
+
+    def recognize(self, path: str) -> Dict:
+        client = self.client or get_client('textract')
+        with open(path, 'rb') as f:
+            document = {'Bytes': f.read()}
+        if self.features:
+            response = client.analyze_document(Document=document, FeatureTypes=self.features)
+        else:
+            response = client.detect_document_text(Document=document)
+        response['Engine'] = self.name
+        return response
+
+    def recognize_batch(self, paths: Sequence[str]) -> List[Dict]:
+        def task(path):
+            return call_with_backoff(lambda p: {'response': self.recognize(p)}, path, self._limiter)['response']
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(task, paths))
+
+
+def tesseract_response(page: Union[str, np.ndarray], lang: str = 'eng', config: str = '') -> Dict:
+    """OCRs one page with Tesseract and returns it in the Textract block schema.
+
+    The page is a PNG path or the pixels themselves, e.g. straight from pdf_rasteriser.rasterise_pdf.
+    Tesseract's block/paragraph/line numbers group the words into LINE blocks; its pixel boxes are
+    divided by the page size, like Textract's.
+    """
+    with (Image.fromarray(page) if isinstance(page, np.ndarray) else Image.open(page)) as image:
+        width, height = image.size
+        data = pytesseract.image_to_data(image, lang=lang, config=config, output_type=pytesseract.Output.DICT)
+
+    words = []
+    for i, text in enumerate(data['text']):
+        # older pytesseract versions return the confidences as strings, '-1' for non-word rows;
+        # a confidence of 0 is a real, if poor, word
+        text = str(text)
+        conf = data['conf'][i]
+        confidence = -1.0 if conf in ('', None) else float(conf)
+        if not text.strip() or confidence < 0:
+            continue
+        left, top = data['left'][i], data['top'][i]
+        words.append((left, top, left + data['width'][i], top + data['height'][i], text,
+                      (data['block_num'][i], data['par_num'][i], data['line_num'][i]), confidence))
+
+    response = words_to_response(words, width, height)
+    response['Engine'] = 'tesseract'
+    return response
+
+
+class TesseractEngine(OcrEngine):
+    """Runs Tesseract locally on a process pool, no network and no cost per page.
+
+    Args:
+        workers (int): Worker processes, os.cpu_count() when None.
+        lang (str): Tesseract languages, e.g. 'eng+deu'.
+        config (str): Extra Tesseract options, e.g. '--psm 6'.
+    """
+
+    name = 'tesseract'
+    result_folder = 'tesseract_ocr'
+
+    def __init__(self, workers: Optional[int] = None, lang: str = 'eng', config: str = ''):
+        self.workers = workers or os.cpu_count()
+        self.lang = lang
+        self.config = config
+        # each tesseract process is single threaded here, the pool provides the parallelism
+        os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def recognize(self, path: str) -> Dict:
+        return tesseract_response(path, self.lang, self.config)
+
+    def recognize_batch(self, paths: Sequence[str]) -> List[Dict]:
+        n = len(paths)
+        return list(self._executor.map(tesseract_response, paths, [self.lang] * n, [self.config] * n,
+                                       chunksize=max(1, n // (4 * self.workers))))
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+
+class EscalatingEngine(OcrEngine):
+    """OCRs every page with a cheap engine and sends only the doubtful ones to an expensive one.
+
+    A page is escalated when its mean WORD confidence is below ``min_confidence`` or when it has
+    fewer than ``min_words`` words; by default pages without any words are trusted to be blank.
+
+    Args:
+        primary (OcrEngine): The engine every page goes through, e.g. TesseractEngine.
+        fallback (OcrEngine): The engine low confidence pages go to, e.g. TextractEngine.
+        min_confidence (float): Mean word confidence, 0 to 100, below which a page is escalated.
+        min_words (int): Pages with fewer words are escalated.
+    """
+
+    name = 'escalating'
+
+    def __init__(self, primary: OcrEngine, fallback: OcrEngine, min_confidence: float = 80.0, min_words: int = 0):
+        self.primary = primary
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+        self.min_words = min_words
+        self.escalated = 0
+
+    def needs_escalation(self, response: Dict) -> bool:
+        confidence = mean_confidence(response)
+        words = sum(1 for b in response['Blocks'] if b['BlockType'] == 'WORD')
+        return words < self.min_words or (confidence is not None and confidence < self.min_confidence)
+
+    def recognize(self, path: str) -> Dict:
+        return self.recognize_batch([path])[0]
+
+    def recognize_batch(self, paths: Sequence[str]) -> List[Dict]:
+        responses = self.primary.recognize_batch(paths)
+        doubtful = [i for i, response in enumerate(responses) if self.needs_escalation(response)]
+        if doubtful:
+            for i, response in zip(doubtful, self.fallback.recognize_batch([paths[i] for i in doubtful])):
+                response['EscalatedFrom'] = {'Engine': responses[i]['Engine'],
+                                             'MeanConfidence': mean_confidence(responses[i])}
+                responses[i] = response
+        self.escalated += len(doubtful)
+        return responses
+
+    def close(self) -> None:
+        self.primary.close()
+        self.fallback.close()
+
+
+def ocr_form_folders(base_destination: str, engine: OcrEngine, batch_size: int = 64,
+                     skip_near_blank: bool = True) -> Dict:
+    """OCRs the page_thumbnails of every form folder under base_destination.
+
+    Each response is written next to the page_thumbnails folder, in ``<engine.result_folder>/<page>.json``,
+    the same layout the Textract scripts use in S3. Pages with a result already are skipped, and
+    so are pages s01 triaged blank or near_blank (near_blank ones are kept with skip_near_blank=False).
+
+    Returns:
+        dict: Page counts, 'pages', 'skipped', 'blank' (left out by the triage) and, for an
+            EscalatingEngine, 'escalated'.
+    """
+    pages = sorted(glob.glob(os.path.join(base_destination, '**', 'page_thumbnails', '*.png'), recursive=True))
+
+    def result_path(page):
+        form_root = os.path.dirname(os.path.dirname(page))
+        return os.path.join(form_root, engine.result_folder, f'{os.path.splitext(os.path.basename(page))[0]}.json')
+
+    skipped = skipped_triage(skip_near_blank=skip_near_blank)
+    triage: Dict[str, Dict[str, str]] = {}
+    content, blank = [], []
+    for page in pages:
+        features = os.path.join(os.path.dirname(os.path.dirname(page)), 'features')
+        if features not in triage:
+            triage[features] = read_page_triage(features)
+        (blank if triage[features].get(os.path.basename(page)) in skipped else content).append(page)
+    pages = content
+
+    todo = [p for p in pages if not os.path.exists(result_path(p))]
+    print(f'{len(pages) - len(todo)} of {len(pages)} pages already have {engine.result_folder} results, '
+          f'{len(blank)} blank pages left out')
+    for i in range(0, len(todo), batch_size):
+        batch = todo[i: i + batch_size]
+        for page, response in zip(batch, engine.recognize_batch(batch)):
+            out = result_path(page)
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            with open(out, 'w') as f:
+                json.dump(response, f)
+        print(f'{min(i + batch_size, len(todo))}/{len(todo)} pages OCRd with {engine.name}')
+
+    stats = {'pages': len(todo), 'skipped': len(pages) - len(todo), 'blank': len(blank)}
+    if isinstance(engine, EscalatingEngine):
+        stats['escalated'] = engine.escalated
+    return stats
+
+
+if __name__ == '__main__':
+    base_destination = sys.argv[1] if len(sys.argv) > 1 else \
+        '/Users/todorlubenov/cytora_data/bulk_emails_processing/allianz_uk_unclassified/attachments_att_images/'
+    with EscalatingEngine(TesseractEngine(), TextractEngine()) as engine:
+        print(ocr_form_folders(base_destination, engine))
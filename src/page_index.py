@@ -0,0 +1,309 @@
+import json
+import re
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from aws_clients import get_client
+from page_triage import PAGE_TRIAGE_FILE, page_triage_classes, skipped_triage
+
+PAGE_INDEX_FILE = 'page_index.sqlite'
+# a listing older than this (seconds) is redone, so pages s01 uploaded since are picked up
+MAX_INDEX_AGE = 3600
+# written by s01 into a canonical form's features folder, the forms deduplicated onto it
+DUPLICATES_FILE = 'duplicates.json'
+
+# cytora_init0001-12.png -> page 12, also matches the zero padded names pdf2image writes
+PAGE_NAME = re.compile(r'-(\d+)\.(\w+)$')
+
+
+def parse_key(key: str) -> Optional[Tuple[str, int, str, str]]:
+    """Splits a page key into its document, page number, kind and extension.
+
+    e.g. ``a/b/page_thumbnails/cytora_init0001-07.png`` -> ``('a/b', 7, 'page_thumbnails', 'png')``, the
+    kind being the folder the page is in (page_thumbnails, aws_textract_ocr, ...). Keys that aren't
+    pages return None.
+    """
+    parts = key.rsplit('/', 2)
+    if len(parts) < 3:
+        return None
+    document, kind, name = parts
+    m = PAGE_NAME.search(name)
+    if not m:
+        return None
+    return document, int(m.group(1)), kind, m.group(2).lower()
+
+
+def parse_page_ranges(pages: str) -> List[Tuple[int, int]]:
+    """Parses a page selection like ``'1-2,5-10'`` or ``'3'`` into inclusive (first, last) ranges."""
+    ranges = []
+    for part in pages.replace(' ', '').split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        ranges.append((int(first), int(last or first)))
+    return ranges
+
+
+def _read_page_triage(bucket: str, key: str) -> List[Tuple[str, int, str]]:
+    """(document, page, triage) rows of a form's features/page_triage.json."""
+    document = key.rsplit('/', 2)[0]
+    body = get_client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+    rows = []
+    for name, triage in page_triage_classes(json.loads(body)).items():
+        m = PAGE_NAME.search(name)
+        if m:
+            rows.append((document, int(m.group(1)), triage))
+    return rows
+
+
+def _read_duplicates(bucket: str, key: str) -> List[Tuple[str, str]]:
+    """(document, duplicate document) rows of a canonical form's features/duplicates.json.
+
+    The file has the form paths relative to s01's destination folder, the duplicates' documents are
+    the canonical document with that relative path swapped.
+    """
+    document = key.rsplit('/', 2)[0]
+    body = json.loads(get_client('s3').get_object(Bucket=bucket, Key=key)['Body'].read())
+    canonical = body['canonical_form'].strip('/')
+    if not document.endswith(canonical):
+        print(f'{key} does not describe {document}, ignored')
+        return []
+    base = document[:len(document) - len(canonical)]
+    return [(document, f"{base}{dup.strip('/')}") for dup in body['duplicates']]
+
+
+def _list_prefix(bucket: str, prefix: str, delimiter: str = '') -> Tuple[List[Dict], List[str]]:
+    paginator = get_client('s3').get_paginator('list_objects_v2')
+    objects, prefixes = [], []
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    for page in paginator.paginate(**kwargs):
+        objects.extend(page.get('Contents', []))
+        prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+    return objects, prefixes
+
+
+def list_objects(bucket: str, prefix: str, workers: int = 16) -> Iterator[Dict]:
+    """Lists every object under prefix, fanning the listing out over its sub prefixes.
+
+    One delimited listing finds the prefix's immediate sub folders (one per email/attachment in the
+    att_images layout), and those are then listed in parallel, each on its own thread's client.
+    """
+    objects, prefixes = _list_prefix(bucket, prefix, delimiter='/')
+    yield from objects
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for sub_objects, _ in executor.map(lambda p: _list_prefix(bucket, p), prefixes):
+            yield from sub_objects
+
+
+class PageIndex:
+    """A local index of the pages stored under S3 prefixes, so selecting pages doesn't relist the bucket.
+
+    ``build`` lists a prefix (again once the listing is older than ``max_age``) and records every page
+    key as (document, page, kind, extension); ``select`` then answers queries like "the page_thumbnails PNGs of pages 1-2" from SQLite.
+    The forms' ``features/page_triage.json`` files are read along, so blank pages can be left out,
+    and so are their ``features/duplicates.json``, so results can be copied to deduplicated forms.
+
+    The connection is not shared between threads, use the index from the driver thread only.
+
+    Args:
+        path (str): The SQLite file.
+    """
+
+    def __init__(self, path: str = PAGE_INDEX_FILE):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'bucket TEXT, key TEXT, document TEXT, page INTEGER, kind TEXT, ext TEXT, size INTEGER, '
+            'etag TEXT, last_modified TEXT, PRIMARY KEY (bucket, key))'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS pages_by_kind ON pages (bucket, kind, page)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS listings (bucket TEXT, prefix TEXT, listed_at REAL, pages INTEGER, '
+            'PRIMARY KEY (bucket, prefix))'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS page_triage (bucket TEXT, document TEXT, page INTEGER, triage TEXT, '
+            'PRIMARY KEY (bucket, document, page))'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS duplicates (bucket TEXT, document TEXT, duplicate TEXT, '
+            'PRIMARY KEY (bucket, duplicate))'
+        )
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def listed_at(self, bucket: str, prefix: str) -> Optional[float]:
+        row = self.conn.execute('SELECT listed_at FROM listings WHERE bucket = ? AND prefix = ?',
+                                (bucket, prefix)).fetchone()
+        return row[0] if row else None
+
+    def build(self, bucket: str, prefix: str, workers: int = 16, refresh: bool = False,
+              max_age: Optional[float] = MAX_INDEX_AGE) -> int:
+        """Lists the prefix and indexes its pages, unless it was listed less than max_age seconds ago.
+
+        Args:
+            bucket (str): The bucket.
+            prefix (str): The prefix, e.g. 'allianz_uk_unclassified/attachments_att_images/'.
+            workers (int): Sub prefixes listed in parallel.
+            refresh (bool): List again even when the listing is recent.
+            max_age (float): Seconds after which a listing is stale and redone, None to never redo it.
+
+        Returns:
+            int: The number of pages indexed under the prefix.
+        """
+        listed_at = self.listed_at(bucket, prefix)
+        if not refresh and listed_at is not None and (max_age is None or time.time() - listed_at < max_age):
+            return self.count(bucket, prefix)
+
+        s = time.perf_counter()
+        for table, column in (('pages', 'key'), ('page_triage', 'document'), ('duplicates', 'document')):
+            self.conn.execute(f"DELETE FROM {table} WHERE bucket = ? AND {column} LIKE ? ESCAPE '\\'",
+                              (bucket, f'{_escape_like(prefix)}%'))
+        rows, triage_keys, duplicates_keys = [], [], []
+        for obj in list_objects(bucket, prefix, workers):
+            if obj['Key'].endswith(f'/features/{PAGE_TRIAGE_FILE}'):
+                triage_keys.append(obj['Key'])
+                continue
+            if obj['Key'].endswith(f'/features/{DUPLICATES_FILE}'):
+                duplicates_keys.append(obj['Key'])
+                continue
+            parsed = parse_key(obj['Key'])
+            if parsed is None:
+                continue
+            rows.append((bucket, obj['Key'], *parsed, obj.get('Size'), obj.get('ETag', '').strip('"'),
+                         str(obj.get('LastModified', ''))))
+        self.conn.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        # one small GET per form, in parallel like the listing
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for triage_rows in executor.map(lambda k: _read_page_triage(bucket, k), triage_keys):
+                self.conn.executemany('INSERT OR REPLACE INTO page_triage VALUES (?, ?, ?, ?)',
+                                      [(bucket, *row) for row in triage_rows])
+            for duplicate_rows in executor.map(lambda k: _read_duplicates(bucket, k), duplicates_keys):
+                self.conn.executemany('INSERT OR REPLACE INTO duplicates VALUES (?, ?, ?)',
+                                      [(bucket, *row) for row in duplicate_rows])
+        self.conn.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)',
+                          (bucket, prefix, time.time(), len(rows)))
+        self.conn.commit()
+        print(f'indexed {len(rows)} pages under s3://{bucket}/{prefix} in {time.perf_counter() - s:.1f} seconds')
+        return len(rows)
+
+    def count(self, bucket: str, prefix: str) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM pages WHERE bucket = ? AND key LIKE ? ESCAPE '\\'",
+                                 (bucket, f'{_escape_like(prefix)}%')).fetchone()[0]
+
+    def select(self, bucket: str, prefix: str, pages: Optional[str] = None, kind: str = 'page_thumbnails',
+               ext: str = 'png', skip_blank: bool = True, skip_near_blank: bool = True) -> List[str]:
+        """Returns the keys of the selected pages, ordered by document and page.
+
+        Args:
+            bucket (str): The bucket.
+            prefix (str): Only keys under this prefix.
+            pages (str): Page ranges like '1-2' or '5-10,12', all pages when None.
+            kind (str): The folder the pages are in, None for any.
+            ext (str): The file extension, None for any.
+            skip_blank (bool): Leave out pages triaged blank, pages without a triage are kept.
+            skip_near_blank (bool): Leave out pages triaged near_blank too, False keeps them (signatures, notes).
+        """
+        query = "SELECT key FROM pages WHERE bucket = ? AND key LIKE ? ESCAPE '\\'"
+        params: List = [bucket, f'{_escape_like(prefix)}%']
+        if kind is not None:
+            query += ' AND kind = ?'
+            params.append(kind)
+        if ext is not None:
+            query += ' AND ext = ?'
+            params.append(ext)
+        if pages:
+            ranges = parse_page_ranges(pages)
+            query += ' AND (' + ' OR '.join('page BETWEEN ? AND ?' for _ in ranges) + ')'
+            params.extend(n for r in ranges for n in r)
+        skipped = skipped_triage(skip_blank, skip_near_blank)
+        if skipped:
+            query += (' AND NOT EXISTS (SELECT 1 FROM page_triage t WHERE t.bucket = pages.bucket'
+                      ' AND t.document = pages.document AND t.page = pages.page'
+                      ' AND t.triage IN (' + ', '.join('?' for _ in skipped) + '))')
+            params.extend(skipped)
+        query += ' ORDER BY document, page'
+        return [row[0] for row in self.conn.execute(query, params)]
+
+    def duplicates(self, bucket: str, document: str) -> List[str]:
+        """The documents s01 deduplicated onto this (canonical) document."""
+        return [row[0] for row in self.conn.execute(
+            'SELECT duplicate FROM duplicates WHERE bucket = ? AND document = ? ORDER BY duplicate',
+            (bucket, document))]
+
+    def canonical(self, bucket: str, document: str) -> str:
+        """The document whose pages and results stand for this one, itself unless it is a duplicate."""
+        row = self.conn.execute('SELECT document FROM duplicates WHERE bucket = ? AND duplicate = ?',
+                                (bucket, document)).fetchone()
+        return row[0] if row else document
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def _escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def select_pages(bucket: str, prefix: str, pages: Optional[str] = None, kind: str = 'page_thumbnails',
+                 refresh: bool = False, index_path: str = PAGE_INDEX_FILE, skip_blank: bool = True,
+                 skip_near_blank: bool = True, max_age: Optional[float] = MAX_INDEX_AGE) -> List[str]:
+    """Builds the index for the prefix if it is missing or stale and returns the selected page keys."""
+    with PageIndex(index_path) as index:
+        index.build(bucket, prefix, refresh=refresh, max_age=max_age)
+        return index.select(bucket, prefix, pages, kind, skip_blank=skip_blank, skip_near_blank=skip_near_blank)
+
+
+def fan_out_results(bucket: str, pages: List[str], result_folder: str, index_path: str = PAGE_INDEX_FILE,
+                    workers: int = 16) -> int:
+    """Copies the results of processed pages to the forms deduplicated onto theirs, server side.
+
+    Duplicates are never rasterised nor OCRd, this gives them the ``<result_folder>/<page>.json``
+    results they would have had, e.g. ``a/dup/aws_textract_ocr/cytora_init0001-1.json``.
+
+    Args:
+        bucket (str): The bucket.
+        pages (list): Page keys whose results are stored, as selected from the index.
+        result_folder (str): The folder the results are in, next to page_thumbnails.
+        index_path (str): The page index, built for the pages' prefix.
+        workers (int): Copies run in parallel.
+
+    Returns:
+        int: The number of results copied.
+    """
+    copies = []
+    with PageIndex(index_path) as index:
+        for page in pages:
+            parsed = parse_key(page)
+            if parsed is None:
+                continue
+            document = parsed[0]
+            stem = page.rsplit('/', 1)[-1].split('.')[0]
+            for duplicate in index.duplicates(bucket, document):
+                copies.append((f'{document}/{result_folder}/{stem}.json',
+                               f'{duplicate}/{result_folder}/{stem}.json'))
+
+    def copy(pair):
+        get_client('s3').copy_object(CopySource={'Bucket': bucket, 'Key': pair[0]}, Bucket=bucket, Key=pair[1])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(copy, copies))
+    print(f'{len(copies)} {result_folder} results copied to duplicate forms')
+    return len(copies)
+
+
+if __name__ == '__main__':
+    # python page_index.py <bucket> <prefix> [pages]
+    keys = select_pages(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None, refresh=True)
+    print(f'{len(keys)} pages selected')
@@ -0,0 +1,150 @@
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from skimage import io
+
+from page_triage import (
+    BLANK_INK_RATIO,
+    INK_DELTA,
+    NEAR_BLANK_INK_RATIO,
+    downsampled_histogram,
+    triage_histogram
+)
+
+PAGE_STATS_FILE = 'page_stats.json'
+
+LEVELS = np.arange(256, dtype=np.float64)
+
+
+def page_shape(image: np.ndarray) -> Tuple[int, int, int]:
+    """Height, width and layers of a page, grayscale pages (2D arrays) having one layer."""
+    if image.ndim == 2:
+        return image.shape[0], image.shape[1], 1
+    return image.shape[0], image.shape[1], image.shape[2]
+
+
+def as_uint8(image: np.ndarray) -> np.ndarray:
+    if image.dtype == np.uint8:
+        return image
+    if image.dtype == np.uint16:
+        return (image >> 8).astype(np.uint8)
+    if image.dtype == bool:
+        return image.astype(np.uint8) * 255
+    # float images as skimage returns them, 0 to 1
+    return np.clip(np.rint(image * 255), 0, 255).astype(np.uint8)
+
+
+# np.bincount casts its input to intp (8 bytes a pixel), so a page is counted this many pixels at a time
+HISTOGRAM_CHUNK_PIXELS = 1 << 20
+
+
+def page_histogram(image: np.ndarray, chunk_pixels: int = HISTOGRAM_CHUNK_PIXELS) -> np.ndarray:
+    """256 bin histogram of a uint8 page, the intp copy bincount makes bounded to chunk_pixels pixels."""
+    flat = image.reshape(-1)
+    hist = np.zeros(256, dtype=np.int64)
+    for start in range(0, flat.size, chunk_pixels):
+        hist += np.bincount(flat[start: start + chunk_pixels], minlength=256)
+    return hist
+
+
+def histogram_stats(hists: np.ndarray) -> Dict[str, np.ndarray]:
+    """The first page statistics render_form used to compute from the pixels, from histograms instead.
+
+    Gives the same values as np.mean/np.median/np.std/np.var/np.average and skimage's
+    shannon_entropy(base=2) over the pixels, without sorting or re-reading them.
+
+    Args:
+        hists (np.ndarray): (pages, 256) counts.
+
+    Returns:
+        dict: 'shannon_entropy_2', 'img_mean', 'img_median', 'img_std', 'img_variance' and
+            'img_average', one value per page.
+    """
+    hists = np.asarray(hists, dtype=np.float64)
+    n = hists.sum(axis=1)
+    mean = hists @ LEVELS / n
+    variance = (hists * (LEVELS[None, :] - mean[:, None]) ** 2).sum(axis=1) / n
+
+    # the middle pixel(s) of the sorted page are the first levels whose cumulative count passes them
+    cdf = hists.cumsum(axis=1)
+    lower = np.argmax(cdf > ((n - 1) // 2)[:, None], axis=1)
+    upper = np.argmax(cdf > (n // 2)[:, None], axis=1)
+
+    p = hists / n[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = -np.where(p > 0, p * np.log2(p), 0.0).sum(axis=1)
+
+    return {
+        'shannon_entropy_2': entropy,
+        'img_mean': mean,
+        'img_median': (lower + upper) / 2,
+        'img_std': np.sqrt(variance),
+        'img_variance': variance,
+        'img_average': mean,
+    }
+
+
+class PageStats:
+    """Collects per page statistics for a form, one histogram per page.
+
+    Pages are histogrammed on ``add`` and only the histograms are kept, so the pixels can be
+    released right after; a second, downsampled histogram per page is taken for the blank page
+    triage.
+    """
+
+    def __init__(self):
+        self.histograms: Dict[str, np.ndarray] = {}
+        self.shapes: Dict[str, Tuple[int, int, int]] = {}
+        self.triage_histograms: Dict[str, np.ndarray] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.shapes
+
+    def add(self, name: str, image: np.ndarray) -> None:
+        self.shapes[name] = page_shape(image)
+        image = as_uint8(image)
+        self.histograms[name] = page_histogram(image)
+        self.triage_histograms[name] = downsampled_histogram(image)
+
+    def add_file(self, name: str, path: str) -> None:
+        self.add(name, io.imread(path))
+
+    def stats(self) -> Dict[str, Dict]:
+        """Statistics per page name, in page name order."""
+        names = sorted(self.histograms)
+        if not names:
+            return {}
+        values = histogram_stats(np.stack([self.histograms[name] for name in names]))
+        pages = {}
+        for i, name in enumerate(names):
+            height, width, layers = self.shapes[name]
+            page = {'height': height, 'width': width, 'layers': layers}
+            page.update({key: float(column[i]) for key, column in values.items()})
+            pages[name] = page
+        return pages
+
+    def triage(self, ink_delta: int = INK_DELTA, blank_ink_ratio: float = BLANK_INK_RATIO,
+               near_blank_ink_ratio: float = NEAR_BLANK_INK_RATIO) -> Dict[str, Dict]:
+        """Blank/near_blank/content triage per page name, see page_triage.triage_histogram."""
+        return {name: triage_histogram(self.triage_histograms[name], ink_delta, blank_ink_ratio, near_blank_ink_ratio)
+                for name in sorted(self.triage_histograms)}
+
+    def write(self, features_folder: str) -> Dict[str, Dict]:
+        """Writes the statistics to ``features_folder/page_stats.json`` and returns them."""
+        pages = self.stats()
+        with open(os.path.join(features_folder, PAGE_STATS_FILE), 'w') as f:
+            json.dump(pages, f)
+        return pages
+
+
+def first_page_fields(page: Optional[Dict]) -> Dict:
+    """The first page fields of the email meta, from the first page's statistics."""
+    if page is None:
+        return {}
+    fields = {'first_page_height': page['height'], 'first_page_width': page['width'],
+              'first_page_layers': page['layers']}
+    fields.update({key: page[key] for key in ('shannon_entropy_2', 'img_mean', 'img_median', 'img_std',
+                                              'img_variance', 'img_average')})
+    return fields
@@ -0,0 +1,96 @@
+import json
+import os
+from typing import Dict, Tuple
+
+import numpy as np
+
+PAGE_TRIAGE_FILE = 'page_triage.json'
+
+BLANK = 'blank'
+NEAR_BLANK = 'near_blank'
+CONTENT = 'content'
+
+# every DOWNSAMPLE-th pixel of every DOWNSAMPLE-th row, 75 DPI out of a 300 DPI page
+DOWNSAMPLE = 4
+# a pixel is ink when it is this far from the page's background level (its most common level);
+# low enough for faint grey print, above the noise of a scanned white page
+INK_DELTA = 48
+# share of ink pixels below which a page is blank / near blank (a fax header, a page number, a stamp)
+BLANK_INK_RATIO = 0.0005
+NEAR_BLANK_INK_RATIO = 0.005
+
+
+def downsampled_histogram(image: np.ndarray, step: int = DOWNSAMPLE) -> np.ndarray:
+    """256 bin histogram of a strided view of a uint8 page, no copy of the full page is made."""
+    return np.bincount(image[::step, ::step].ravel(), minlength=256)
+
+
+def triage_thresholds(ink_delta: int = INK_DELTA, blank_ink_ratio: float = BLANK_INK_RATIO,
+                      near_blank_ink_ratio: float = NEAR_BLANK_INK_RATIO) -> Dict:
+    """The thresholds triage_histogram uses, the defaults overridden by the arguments given."""
+    return {'downsample': DOWNSAMPLE, 'ink_delta': ink_delta, 'blank_ink_ratio': blank_ink_ratio,
+            'near_blank_ink_ratio': near_blank_ink_ratio}
+
+
+def triage_histogram(hist: np.ndarray, ink_delta: int = INK_DELTA, blank_ink_ratio: float = BLANK_INK_RATIO,
+                     near_blank_ink_ratio: float = NEAR_BLANK_INK_RATIO) -> Dict:
+    """Classifies a page as blank, near_blank or content from its (downsampled) histogram.
+
+    Works for dark pages too, ink is measured against the page's own background level.
+
+    Returns:
+        dict: 'triage', the 'background' level, the 'ink_ratio' and the downsampled 'std'.
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    n = hist.sum()
+    levels = np.arange(256)
+    background = int(np.argmax(hist))
+    ink_ratio = float(hist[np.abs(levels - background) > ink_delta].sum() / n) if n else 0.0
+    mean = hist @ levels / n if n else 0.0
+    std = float(np.sqrt(hist @ (levels - mean) ** 2 / n)) if n else 0.0
+
+    if ink_ratio < blank_ink_ratio:
+        triage = BLANK
+    elif ink_ratio < near_blank_ink_ratio:
+        triage = NEAR_BLANK
+    else:
+        triage = CONTENT
+    return {'triage': triage, 'background': background, 'ink_ratio': ink_ratio, 'std': std}
+
+
+def skipped_triage(skip_blank: bool = True, skip_near_blank: bool = True) -> Tuple[str, ...]:
+    """The triage classes left out of OCR, blank and near blank (fax covers, separator sheets) pages by
+    default. Near blank pages may hold a short note or a signature, skip_near_blank=False keeps them."""
+    return tuple(triage for triage, skip in ((BLANK, skip_blank), (NEAR_BLANK, skip_near_blank)) if skip)
+
+
+def write_page_triage(features_folder: str, pages: Dict[str, Dict], thresholds: Dict) -> Dict:
+    """Writes ``features_folder/page_triage.json`` and returns a summary.
+
+    The file has the 'thresholds' the pages were triaged with and 'pages', page file name to its
+    triage.
+
+    Returns:
+        dict: 'pages' (page file name to blank/near_blank/content), the count per class and the
+            'thresholds', for the meta.
+    """
+    with open(os.path.join(features_folder, PAGE_TRIAGE_FILE), 'w') as f:
+        json.dump({'thresholds': thresholds, 'pages': pages}, f)
+    summary = {'pages': {name: page['triage'] for name, page in pages.items()}, 'thresholds': thresholds}
+    for triage in (BLANK, NEAR_BLANK, CONTENT):
+        summary[triage] = sum(1 for page in pages.values() if page['triage'] == triage)
+    return summary
+
+
+def page_triage_classes(triage: Dict) -> Dict[str, str]:
+    """Page file name to its triage class, from the content of a page_triage.json."""
+    return {name: page['triage'] for name, page in triage['pages'].items()}
+
+
+def read_page_triage(features_folder: str) -> Dict[str, str]:
+    """Page file name to its triage class, empty when the form has no triage."""
+    path = os.path.join(features_folder, PAGE_TRIAGE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return page_triage_classes(json.load(f))
@@ -0,0 +1,223 @@
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+import fitz
+import numpy as np
+from pdf2image import convert_from_path
+from skimage import io
+
+RASTERISE_PROGRESS_FILE = 'rasterise_progress.json'
+
+# PyMuPDF must not be used from two threads at once and processing_threaded renders forms on a
+# thread pool, every fitz call in the pipeline holds this lock
+FITZ_LOCK = threading.Lock()
+
+
+def page_file_name(fname: str, page: int, num_pages: int) -> str:
+    """The name pdf2image/pdftoppm give a page, e.g. ``cytora_init0001-07.png`` for page 7 of 12.
+
+    pdf2image appends a 4 digit counter to output_file, pdftoppm appends the page number padded to
+    the number of digits of the page count.
+    """
+    return f'{fname}0001-{page:0{len(str(num_pages))}d}.png'
+
+
+def pixmap_array(pix: 'fitz.Pixmap') -> np.ndarray:
+    """The pixmap's samples as an array, (height, width) for grayscale like skimage.io.imread returns."""
+    arr = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    return arr[:, :, 0] if pix.n == 1 else arr
+
+
+def rasterise_pdf(pdf_path: str, dest_folder: Optional[str] = None, dpi: int = 250, grayscale: bool = True,
+                  fname: str = 'cytora_init', first_page: int = 1, last_page: Optional[int] = None,
+                  pages: Optional[Sequence[int]] = None) -> Iterator[Tuple[int, Optional[str], np.ndarray]]:
+    """Renders the pages of a PDF in process with PyMuPDF.
+
+    Pages are yielded one by one as arrays, so callers can compute stats or OCR without reading
+    anything back from disk; the PNGs are written as a side output when dest_folder is given, with
+    the file names generate_images_from_pdf (pdf2image) uses.
+
+    Args:
+        pdf_path (str): The PDF.
+        dest_folder (str): Folder the PNGs are written to, None to skip writing them.
+        dpi (int): Render resolution.
+        grayscale (bool): Render 8 bit grayscale instead of RGB.
+        fname (str): The file name prefix, like pdf2image's output_file.
+        first_page (int): First page to render, 1 based.
+        last_page (int): Last page to render, the last page of the document when None.
+        pages (list): Only render these 1 based page numbers (within first_page..last_page).
+
+    Yields:
+        tuple: The 1 based page number, the PNG path (None when not written) and the pixels.
+    """
+    matrix = fitz.Matrix(dpi / 72, dpi / 72)
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    # the lock is only held while fitz works, not while the caller has a page
+    with FITZ_LOCK:
+        doc = fitz.open(pdf_path)
+    try:
+        num_pages = doc.page_count
+        last_page = min(last_page or num_pages, num_pages)
+        for page_number in range(first_page, last_page + 1):
+            if pages is not None and page_number not in pages:
+                continue
+            path = None
+            with FITZ_LOCK:
+                pix = doc[page_number - 1].get_pixmap(matrix=matrix, colorspace=colorspace, alpha=False)
+                if dest_folder is not None:
+                    path = os.path.join(dest_folder, page_file_name(fname, page_number, num_pages))
+                    pix.save(path)
+            yield page_number, path, pixmap_array(pix)
+    finally:
+        with FITZ_LOCK:
+            doc.close()
+
+
+def page_ranges(pages: Sequence[int]) -> List[Tuple[int, int]]:
+    """Groups page numbers into contiguous (first, last) runs, e.g. [1, 2, 3, 7] -> [(1, 3), (7, 7)]."""
+    ranges: List[Tuple[int, int]] = []
+    for page in sorted(pages):
+        if ranges and page == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], page)
+        else:
+            ranges.append((page, page))
+    return ranges
+
+
+def page_windows(pages: Sequence[int], window: int) -> List[Tuple[int, int]]:
+    """Splits page numbers into contiguous (first, last) windows of at most ``window`` pages."""
+    windows: List[Tuple[int, int]] = []
+    for first, last in page_ranges(pages):
+        for start in range(first, last + 1, window):
+            windows.append((start, min(start + window - 1, last)))
+    return windows
+
+
+def page_count(pdf_path: str) -> int:
+    """The number of pages in the PDF."""
+    with FITZ_LOCK, fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+
+def page_raster_bytes(pdf_path: str, dpi: int, grayscale: bool = True) -> List[int]:
+    """The size of every page's raster at dpi, page n at index n - 1, from the page sizes alone."""
+    with FITZ_LOCK, fitz.open(pdf_path) as doc:
+        return [math.ceil(page.rect.width * dpi / 72) * math.ceil(page.rect.height * dpi / 72) * (1 if grayscale else 3)
+                for page in doc]
+
+
+class MemoryBudget:
+    """Bounds the bytes reserved by concurrent renders, threads block in ``reserve`` until theirs fit.
+
+    A reservation larger than the whole budget is cut down to it, so an oversized page still renders,
+    alone.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size: int):
+        size = min(size, self.limit)
+        with self._cond:
+            self._cond.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.used -= size
+                self._cond.notify_all()
+
+
+def raster_source(pdf_path: str, **settings) -> Dict:
+    """What a rasterisation's progress is only valid for: the PDF's size and mtime, and the render settings."""
+    st = os.stat(pdf_path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, **settings}
+
+
+class RasterProgress:
+    """The page windows of a PDF rendered so far, so a form interrupted mid document resumes from them.
+
+    Kept in a JSON file outside page_thumbnails and rewritten (write then rename) after every
+    window, from any thread. A file written for another source or other settings is ignored.
+
+    Args:
+        path (str): The progress file, e.g. the form's features/rasterise_progress.json.
+        source (dict): See raster_source.
+    """
+
+    def __init__(self, path: str, source: Dict):
+        self.path = path
+        self.source = source
+        self.done: Set[Tuple[int, int]] = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    saved = json.load(f)
+            except ValueError:
+                # torn by a crash, start over
+                saved = {}
+            if saved.get('source') == source:
+                self.done = {tuple(window) for window in saved.get('windows', [])}
+
+    def __contains__(self, window: Tuple[int, int]) -> bool:
+        return tuple(window) in self.done
+
+    def mark(self, window: Tuple[int, int]) -> None:
+        with self._lock:
+            self.done.add(tuple(window))
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'source': self.source, 'windows': sorted(self.done)}, f)
+            os.replace(tmp, self.path)
+
+    def finish(self) -> None:
+        """Drops the progress file once every window is rendered."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def benchmark_rasterisers(pdf_path: str, dpi: int = 300, repeat: int = 3) -> Dict:
+    """Compares pages per second of pdf2image (pdftoppm subprocess, PNGs then read back) and PyMuPDF.
+
+    Both write the PNGs; the pdf2image timing includes reading the first page back with
+    skimage.io.imread like render_form used to, the PyMuPDF one already has it in memory.
+    """
+    stats = {}
+    workdir = tempfile.mkdtemp(prefix='rasterise_benchmark_')
+    try:
+        for name in ('pdf2image', 'fitz'):
+            elapsed, pages = 0.0, 0
+            for _ in range(repeat):
+                out = tempfile.mkdtemp(dir=workdir)
+                s = time.perf_counter()
+                if name == 'pdf2image':
+                    convert_from_path(pdf_path, dpi=dpi, output_folder=out, grayscale=True,
+                                      output_file='cytora_init', fmt='png')
+                    files = sorted(os.listdir(out))
+                    io.imread(os.path.join(out, files[0]))
+                    pages += len(files)
+                else:
+                    pages += sum(1 for _ in rasterise_pdf(pdf_path, out, dpi=dpi))
+                elapsed += time.perf_counter() - s
+            stats[name] = pages / elapsed if elapsed else 0.0
+            print(f'{name}: {stats[name]:.2f} pages/sec')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return stats
+
+
+if __name__ == '__main__':
+    benchmark_rasterisers(sys.argv[1], dpi=int(sys.argv[2]) if len(sys.argv) > 2 else 300)
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Dict, List
+
+# the order matters: a stage is only trusted when every stage before it is done too
+STAGES = ('copied', 'converted', 'rasterised', 'stats')
+
+MANIFEST_FILE_NAME = 'processing_manifest.sqlite'
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ProcessingManifest:
+    """Records which processing stages are done for every source file.
+
+    Rows are keyed by source path and carry the file size, mtime and SHA-256 it had when the stages
+    ran. A file whose size and mtime are unchanged is trusted without rehashing; when they differ
+    the content hash decides whether the recorded stages are still valid (a touched but identical
+    file keeps them, a changed one starts over).
+
+    The connection is not shared between threads, use the manifest from the driver thread only.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        stage_columns = ', '.join(f'{stage} REAL' for stage in STAGES)
+        self.conn.execute(
+            f'CREATE TABLE IF NOT EXISTS files ('
+            f'source_path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT, {stage_columns}, updated_at REAL)'
+        )
+        self.conn.commit()
+
+    @classmethod
+    def for_destination(cls, base_destination: str) -> 'ProcessingManifest':
+        os.makedirs(base_destination, exist_ok=True)
+        return cls(os.path.join(base_destination, MANIFEST_FILE_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def completed_stages(self, source_path: str) -> List[str]:
+        """Returns the stages that don't need to run again for a source file.
+
+        Registers the file when it is new and forgets its stages when its content changed.
+
+        Args:
+            source_path (str): The absolute path of the source file.
+
+        Returns:
+            list: The leading completed stages, in STAGES order.
+        """
+        st = os.stat(source_path)
+        row = self.conn.execute(
+            f"SELECT size, mtime, sha256, {', '.join(STAGES)} FROM files WHERE source_path = ?", (source_path,)
+        ).fetchone()
+
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime:
+            return self._leading_stages(row[3:])
+
+        sha256 = file_sha256(source_path)
+        if row is not None and row[2] == sha256:
+            self.conn.execute('UPDATE files SET size = ?, mtime = ?, updated_at = ? WHERE source_path = ?',
+                              (st.st_size, st.st_mtime, time.time(), source_path))
+            self.conn.commit()
+            return self._leading_stages(row[3:])
+
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO files (source_path, size, mtime, sha256, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (source_path, st.st_size, st.st_mtime, sha256, time.time())
+        )
+        self.conn.commit()
+        return []
+
+    @staticmethod
+    def _leading_stages(values) -> List[str]:
+        done = []
+        for stage, value in zip(STAGES, values):
+            if value is None:
+                break
+            done.append(stage)
+        return done
+
+    def mark(self, source_path: str, stages: List[str]) -> None:
+        """Records stages as completed now; stages not passed are cleared."""
+        now = time.time()
+        values = [now if stage in stages else None for stage in STAGES]
+        assignments = ', '.join(f'{stage} = ?' for stage in STAGES)
+        self.conn.execute(f'UPDATE files SET {assignments}, updated_at = ? WHERE source_path = ?',
+                          (*values, now, source_path))
+        self.conn.commit()
+
+    def summary(self) -> Dict:
+        counts = {'files': self.conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]}
+        for stage in STAGES:
+            counts[stage] = self.conn.execute(f'SELECT COUNT(*) FROM files WHERE {stage} IS NOT NULL').fetchone()[0]
+        return counts
+
+    def close(self) -> None:
+        self.conn.close()
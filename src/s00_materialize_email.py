@@ -1,5 +1,6 @@
 
 import mailbox
+import mmap
 import bs4
 import pandas as pd
 import json
@@ -16,7 +17,13 @@ from pathlib import Path
 from datetime import datetime
 import numpy as np
 import time
-from eml_unpack import EMLExtractor
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+from eml_unpack import EMLExtractor, render_bodies
+from body_renderer import WkhtmltopdfPool
+from attachment_sinks import DirectorySink
+from attachment_store import AttachmentStore
 
 import structlog
 
@@ -37,6 +44,91 @@ def dropSelectionArtifacts(subj_text):
     return ret
 
 
+MBOX_SEPARATOR = b'\nFrom '
+
+
+def iter_mbox_messages(base_file: str, start: int = 0, end: int = None):
+    """Yields the messages of an mbox file in a single pass over an mmap of it.
+
+    Unlike mailbox.mbox, no table of contents is built and nothing but the current message is
+    held in memory, so it works on mailboxes larger than RAM.
+
+    Args:
+        base_file (str): The path to the mbox file.
+        start (int): The byte offset to start at, must be the start of a "From " line.
+        end (int): The byte offset to stop at, the end of the file if not passed.
+
+    Yields:
+        mailbox.mboxMessage: The parsed messages, in file order.
+    """
+    with open(base_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = len(mm) if end is None else end
+            pos = start
+            if mm[pos:pos + 5] != b'From ':
+                # not on a message boundary, skip to the first one
+                pos = mm.find(MBOX_SEPARATOR, pos, end)
+                if pos == -1:
+                    return
+                pos += 1
+            while pos < end:
+                nxt = mm.find(MBOX_SEPARATOR, pos, end)
+                stop = end if nxt == -1 else nxt
+                yield _mbox_message(mm[pos:stop])
+                pos = stop + 1
+
+
+def scan_mbox_offsets(base_file: str) -> List[int]:
+    """Returns the byte offset of every message start in an mbox file, without parsing anything."""
+    offsets = []
+    with open(base_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return offsets
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:5] == b'From ':
+                offsets.append(0)
+            pos = mm.find(MBOX_SEPARATOR)
+            while pos != -1:
+                offsets.append(pos + 1)
+                pos = mm.find(MBOX_SEPARATOR, pos + 1)
+    return offsets
+
+
+def shard_mbox(base_file: str, num_shards: int) -> List[Tuple[int, int]]:
+    """Splits an mbox file into byte ranges of roughly equal size that start and end on message boundaries.
+
+    Args:
+        base_file (str): The path to the mbox file.
+        num_shards (int): The wanted number of shards, fewer are returned for small mailboxes.
+
+    Returns:
+        list: (start, end) byte offsets, to be passed to iter_mbox_messages.
+    """
+    offsets = scan_mbox_offsets(base_file)
+    if not offsets:
+        return []
+    size = os.path.getsize(base_file)
+    target = size / max(num_shards, 1)
+
+    shards = []
+    start = offsets[0]
+    for offset in offsets[1:]:
+        if offset - start >= target:
+            shards.append((start, offset))
+            start = offset
+    shards.append((start, size))
+    return shards
+
+
+def _mbox_message(raw: bytes) -> mailbox.mboxMessage:
+    from_line, _, body = raw.partition(b'\n')
+    msg = mailbox.mboxMessage(body)
+    msg.set_from(from_line[5:].rstrip(b'\r').decode('ascii', errors='replace'))
+    return msg
+
+
 def get_html_text(html):
     try:
         return bs4.BeautifulSoup(html, 'lxml').body.get_text(' ', strip=True)
@@ -50,7 +142,7 @@ class GmailMboxMessage():
             raise TypeError('Variable must be type mailbox.mboxMessage')
         self.email_data = email_data
 
-    def parse_email(self, write_attachments=False):
+    def parse_email(self, write_attachments=False, store=None):
         # email meta
         self.email_labels = self.email_data['X-Gmail-Labels']
         self.email_date = self.email_data['Date']
@@ -77,7 +169,8 @@ class GmailMboxMessage():
         self.uid = uid
 
         # attachments
-        self.attachments = self.get_attachments(write_attachments)
+        self.attachment_refs = []
+        self.attachments = self.get_attachments(write_attachments, store)
 
     def get_raw_text(self):
         text = [x[2] for x in self.email_contents if x[0] == "text/html"]
@@ -139,7 +232,8 @@ class GmailMboxMessage():
             msg_text = None
         return (content_type, encoding, msg_text)
 
-    def get_attachments(self, write_attachments=False):
+    def get_attachments(self, write_attachments=False, store=None):
+        # with an AttachmentStore the files are hard links to one blob per distinct content
         filenames = []
         for part in self.email_data.walk():
             if part.get_content_maintype() == 'multipart':
@@ -153,7 +247,10 @@ class GmailMboxMessage():
                 filenames.append(filename)
                 filepath = os.path.join(ATTACHMENT_DIR, self.uid, filename)
                 payload = part.get_payload(decode=True)
-                if payload is not None and write_attachments:
+                if payload is not None and store is not None:
+                    ref = store.store(payload, filepath)
+                    self.attachment_refs.append({'filename': filename, 'sha256': ref['sha256'], 'size': ref['size']})
+                elif payload is not None and write_attachments:
                     if not os.path.isdir(os.path.dirname(filepath)):
                         os.makedirs(os.path.dirname(filepath))
                     with open(filepath, 'wb')as f:
@@ -198,67 +295,118 @@ def process_eml_file(base_file: str):
         print(ex)
 
 
-def process_mbox_file(base_file: str):
-    mbox_obj = mailbox.mbox(base_file)
-
-    num_entries = len(mbox_obj)
-    print(num_entries)
-
-    # emails_parsed = [None for x in range(num_entries)]
-    emails_parsed = []
-    for i in range(num_entries):
-        try:
-            msg = mbox_obj[i]
-            email_data = GmailMboxMessage(msg)
-            email_data.parse_email(write_attachments=True)
-            # email_data.save_email_body()
-            o = vars(email_data)
-            del o['email_data']
-            emails_parsed.append(o)
-        except Exception as ex:
-            print(ex)
-
-    with open('json_data.json', 'w') as outfile:
-        json.dump(emails_parsed, outfile)
-
-
-def _process_mbox_file(base_file: str):
-    # load mailbox data
-    mbox_obj = mailbox.mbox(base_file)
-
-    num_entries = len(mbox_obj)
+def process_mbox_file(base_file: str, out_file: str = 'json_data.jsonl', store_root: str = None):
+    num_entries = _process_mbox_shard(base_file, 0, None, out_file, store_root)
     print(num_entries)
 
-    # parse mailbox data
-    emails_parsed = [None for x in range(num_entries)]
-    for i in range(num_entries):
-        try:
-            msg = mbox_obj[i]
-            fname = 'AS8PR08MB6055A823D0B781863ECACC3AD4639'
-            extractor = EMLExtractor(msg, fname)# fn.split("/")[-1])
 
-            attachments = extractor.documents
+def _process_mbox_shard(base_file: str, start: int, end: int, out_file: str, store_root: str = None) -> int:
+    # one JSON object per line, written as soon as the email is parsed so memory stays flat
+    store = AttachmentStore(store_root) if store_root else None
+    num_entries = 0
+    with open(out_file, 'w') as outfile:
+        for msg in iter_mbox_messages(base_file, start, end):
+            num_entries += 1
+            try:
+                email_data = GmailMboxMessage(msg)
+                email_data.parse_email(write_attachments=True, store=store)
+                # email_data.save_email_body()
+                o = vars(email_data)
+                del o['email_data']
+                outfile.write(json.dumps(o) + '\n')
+            except Exception as ex:
+                print(ex)
+    return num_entries
+
+
+def _init_shard_worker(attachment_dir: str):
+    # ATTACHMENT_DIR is only set when this file runs as a script, spawned workers need it passed in
+    global ATTACHMENT_DIR
+    ATTACHMENT_DIR = attachment_dir
+
+
+def merge_partitions(partition_files: List[str], out_file: str):
+    with open(out_file, 'wb') as outfile:
+        for partition_file in partition_files:
+            with open(partition_file, 'rb') as f:
+                shutil.copyfileobj(f, outfile)
+            os.remove(partition_file)
+
+
+def process_mbox_file_parallel(base_file: str, out_file: str = 'json_data.jsonl', workers: int = None,
+                               shards_per_worker: int = 4, attachment_dir: str = None, store_root: str = None):
+    """Parses an mbox file with a process pool, one byte range shard per task.
+
+    The mbox is scanned once for message boundaries and cut into shards; every worker parses its
+    shard with iter_mbox_messages, writes the attachments and a JSON Lines partition, and the
+    partitions are concatenated into out_file in mailbox order at the end. There are a few shards
+    per worker so that a shard full of large emails doesn't leave the other workers idle.
+
+    Args:
+        base_file (str): The path to the mbox file.
+        out_file (str): The JSON Lines file the parsed emails are written to.
+        workers (int): Number of worker processes, os.cpu_count() if not passed.
+        shards_per_worker (int): Number of shards per worker.
+        attachment_dir (str): Where attachments are written, ATTACHMENT_DIR if not passed.
+        store_root (str): Root of an AttachmentStore to deduplicate attachments into, plain files if not passed.
+    """
+    workers = workers or os.cpu_count() or 1
+    attachment_dir = attachment_dir or globals().get('ATTACHMENT_DIR')
+
+    s = time.perf_counter()
+    shards = shard_mbox(base_file, workers * shards_per_worker)
+    print(f'{len(shards)} shards found in {time.perf_counter() - s} seconds')
+
+    partition_files = [f'{out_file}.part{i:05d}' for i in range(len(shards))]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_shard_worker,
+                             initargs=(attachment_dir,)) as executor:
+        futures = [executor.submit(_process_mbox_shard, base_file, start, end, partition_file, store_root)
+                   for (start, end), partition_file in zip(shards, partition_files)]
+        num_entries = sum(future.result() for future in futures)
+
+    merge_partitions(partition_files, out_file)
+    elapsed = time.perf_counter() - s
+    print(f'{num_entries} emails parsed in {elapsed} seconds, {num_entries / elapsed if elapsed else 0:.2f} emails/sec '
+          f'with {workers} workers')
+
+
+def _render_body_batch(batch: List):
+    # one render_batch call for the html bodies of the whole batch, then every body goes to its email's sink
+    try:
+        render_bodies([extractor for extractor, _ in batch])
+        for extractor, sink in batch:
             if extractor.body_document:
-                attachments.append(extractor.body_document)
-
-            import os
-
-            dirname = f'/Users/todorlubenov/cytora_data/bulk_datas/test/my_pdf_renders/{fname}'
-            os.makedirs(dirname, exist_ok=True)
-            for attachment in attachments:
-                # if attachment.content_type == ''
-                with open(f"{dirname}/{attachment.name}", "wb") as f:
-                    f.write(attachment.content)
-            '''
-            print(f'{i+1} / {num_entries}')
-            email_obj = mbox_obj[i]
-            email_data = GmailMboxMessage(email_obj)
-            email_data.parse_email(write_attachments=True)
-            email_data.save_email_body()
-            emails_parsed[i] = email_data
-            '''
-        except Exception as ex:
-            print(ex)
+                sink.consume(extractor.body_document)
+    except Exception as ex:
+        print(ex)
+    batch.clear()
+
+
+def _process_mbox_file(base_file: str, batch_size: int = 32):
+    # bodies are rendered batch_size emails at a time, so wkhtmltopdf starts once per pool slot per batch
+    batch = []
+    with WkhtmltopdfPool() as renderer:
+        # parse mailbox data
+        for msg in iter_mbox_messages(base_file):
+            try:
+                fname = 'AS8PR08MB6055A823D0B781863ECACC3AD4639'
+                dirname = f'/Users/todorlubenov/cytora_data/bulk_datas/test/my_pdf_renders/{fname}'
+                sink = DirectorySink(dirname)
+                extractor = EMLExtractor(msg, fname, renderer=renderer, sink=sink)# fn.split("/")[-1])
+                batch.append((extractor, sink))
+                if len(batch) >= batch_size:
+                    _render_body_batch(batch)
+                '''
+                print(f'{i+1} / {num_entries}')
+                email_obj = mbox_obj[i]
+                email_data = GmailMboxMessage(email_obj)
+                email_data.parse_email(write_attachments=True)
+                email_data.save_email_body()
+                emails_parsed[i] = email_data
+                '''
+            except Exception as ex:
+                print(ex)
+        _render_body_batch(batch)
 
 
 if __name__ == '__main__':
@@ -283,7 +431,8 @@ if __name__ == '__main__':
         print('Convert to eml and call process_eml_file')
 
     if suff == '.mbox':
-        process_mbox_file(source_file)
+        process_mbox_file(source_file, store_root=f"{ATTACHMENT_DIR.rstrip('/')}_blobs")
+        # process_mbox_file_parallel(source_file, workers=8)
         print('open it and iter using process_eml_file')
 
 
@@ -14,6 +14,8 @@ import pathlib
 import shutil
 import datetime
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 import numpy as np
 import pandas as pd
@@ -33,6 +35,22 @@ from pdf2image.exceptions import (
     PDFSyntaxError
 )
 
+from libreoffice_pool import LibreOfficePool, OFFICE_EXTENSIONS
+from pdf_rasteriser import (
+    RASTERISE_PROGRESS_FILE,
+    MemoryBudget,
+    RasterProgress,
+    page_count,
+    page_raster_bytes,
+    page_windows,
+    raster_source,
+    rasterise_pdf
+)
+from page_stats import PageStats, first_page_fields
+from page_triage import skipped_triage, triage_histogram, triage_thresholds, write_page_triage
+from processing_manifest import ProcessingManifest, STAGES, file_sha256
+from text_layer import extract_text_layer, read_text_layer
+
 # sys.path.insert(0, '../')
 # from src.doc2pdf import get_office_cli_path, convert
 
@@ -40,6 +58,7 @@ from pdf2image.exceptions import (
 __version__ = '0.2.0'
 
 import platform, subprocess, tempfile, os, shutil
+from multiprocessing.util import Finalize
 
 
 def get_platform():
@@ -100,12 +119,13 @@ def get_office_cli_path():
         raise Exception('Unsupported platform')
 
 
-def convert(in_file, out_file=None):
+def convert(in_file, out_file=None, timeout=None):
     """Converts a file to PDF.
 
     Args:
         in_file (str): The path to the input file.
         out_file (str): The path to the output file, same path to in_file if not passes.
+        timeout (int): Seconds after which a hung LibreOffice is killed, no limit if not passed.
     """
 
     if not out_file:
@@ -122,7 +142,7 @@ def convert(in_file, out_file=None):
         '--outdir',
         outdir,
         in_file
-    ])
+    ], timeout=timeout)
 
     if out_file:
         out_temp_file_arr = os.path.splitext(in_file)
@@ -131,6 +151,28 @@ def convert(in_file, out_file=None):
         shutil.move(os.path.join(outdir, out_temp_file_name), out_file)
 
 
+_office_pool = None
+
+
+def get_office_pool(size: int = 1, timeout: int = 120) -> LibreOfficePool:
+    """Returns the LibreOffice pool of this process, started on first use and closed at exit.
+
+    Args:
+        size (int): Number of LibreOffice instances, only used when the pool is created.
+        timeout (int): Seconds after which a hung conversion is killed, only used when the pool is created.
+
+    Returns:
+        LibreOfficePool: The process wide pool.
+    """
+    global _office_pool
+    if _office_pool is None:
+        _office_pool = LibreOfficePool(size, soffice=get_office_cli_path(), timeout=timeout)
+        # atexit handlers don't run in ProcessPoolExecutor workers, multiprocessing's exit finalizers
+        # do (and run at interpreter exit in the main process too), so every soffice and profile goes
+        Finalize(_office_pool, _office_pool.close, exitpriority=10)
+    return _office_pool
+
+
 def filename_normalizer(fname: str, suffix: str):
     tmp = f'{fname}{suffix}'.lower()
     chars = "!@#$%^&*()[]{};:,./<>?\|`~-=_+'\"_"
@@ -163,65 +205,226 @@ def get_suff_files_list_of_objects(base_uri: str, suffix: str) -> List:
     return suff_files
 
 
-def create_form_folder(dest_folder: str, form_object: Dict):
-    s = os.getcwd()
-    print(s)
-    # sub = pathlib.PurePath(form_object['root_path']).name
-    sub = form_object['root_path']
+def dedupe_doc_files(doc_files: List) -> List:
+    """Keeps one file object per distinct content, the others are attached to it as 'duplicates'.
+
+    Files written through an AttachmentStore are hard links to the same blob and are matched by
+    inode; files of the same size that aren't linked are compared by SHA-256.
+
+    Args:
+        doc_files (list): The file objects from get_suff_files_list_of_objects.
+
+    Returns:
+        list: The canonical file objects, each with a (possibly empty) 'duplicates' list.
+    """
+    by_inode = {}
+    for el in doc_files:
+        st = os.stat(el['abs_path'])
+        by_inode.setdefault((st.st_dev, st.st_ino), []).append(el)
+
+    by_size = {}
+    for group in by_inode.values():
+        by_size.setdefault(group[0]['st_size_bytes'], []).append(group)
+
+    uniques = []
+    for groups in by_size.values():
+        if len(groups) > 1:
+            by_hash = {}
+            for group in groups:
+                by_hash.setdefault(file_sha256(group[0]['abs_path']), []).extend(group)
+            groups = list(by_hash.values())
+        for group in groups:
+            canonical = group[0]
+            canonical['duplicates'] = group[1:]
+            uniques.append(canonical)
+    print(f'{len(uniques)} distinct files out of {len(doc_files)}')
+    return uniques
+
+
+DUPLICATES_FILE = 'duplicates.json'
+# ocr_engines.TesseractEngine.result_folder, the fitz rasteriser writes its in process OCR there
+TESSERACT_RESULT_FOLDER = 'tesseract_ocr'
+
+
+def fan_out_meta(el: Dict, base_destination: str, suffix: str):
+    """Writes a meta JSON for every duplicate of a processed file, pointing at the canonical form folder.
+
+    The duplicates get the imagery and stats of the canonical file, and 'canonical_form' tells
+    downstream stages (thumbnails, Textract results) where the processed pages live; duplicates
+    have no form folder of their own, so they get no 'dpath'. The canonical form lists its
+    duplicates in ``features/duplicates.json``, which the page index reads to copy Textract
+    results to them.
+    """
+    duplicates = el.pop('duplicates', [])
+    canonical_form = f"{el['root_path']}/{el['dpath']}"
+    duplicate_forms = []
+    for dup in duplicates:
+        meta = {k: v for k, v in el.items()
+                if k not in ('file_name', 'root_path', 'abs_path', 'st_size_bytes', 'dpath')}
+        meta.update(dup)
+        meta['file_name_normalized'] = filename_normalizer(dup['file_name'], suffix)
+        meta['canonical_form'] = canonical_form
+        write_meta(meta, base_destination)
+        duplicate_forms.append(f"{dup['root_path']}/{meta['file_name_normalized']}")
+    if duplicate_forms:
+        with open(f"{base_destination}{canonical_form}/features/{DUPLICATES_FILE}", 'w') as f:
+            json.dump({'canonical_form': canonical_form, 'duplicates': duplicate_forms}, f)
+    el['duplicate_count'] = len(duplicates)
+
+
+# every form folder gets the same layout, the source form is copied into "source_form"
+FORM_SUBFOLDERS = ('source_form', 'page_images', 'page_thumbnails', 'text_layer', 'experiments', 'features')
+
+
+def form_folder_paths(dest_folder: str, form_object: Dict) -> Dict:
+    """Returns the absolute paths of a form folder and its sub folders without touching the disk.
+
+    Args:
+        dest_folder (str): The destination base folder.
+        form_object (dict): The file object, needs 'root_path', 'file_name_normalized' and 'extension'.
+
+    Returns:
+        dict: Paths keyed by 'root', the names in FORM_SUBFOLDERS and 'source_file'.
+    """
+    root = f"{dest_folder}/{form_object['root_path']}/{form_object['file_name_normalized']}"
+    paths = {'root': root}
+    for name in FORM_SUBFOLDERS:
+        paths[name] = f'{root}/{name}'
+    paths['source_file'] = f"{root}/source_form/{form_object['file_name_normalized']}{form_object['extension']}"
+    return paths
+
 
-    sub_folder = f'{dest_folder}/{sub}'
-    if not os.path.exists(sub_folder):
-        os.makedirs(sub_folder)
+def materialize_form_folder(dest_folder: str, form_object: Dict, copy_source: bool = True) -> Dict:
+    """Creates the form folder layout in one pass and copies the source form into it.
 
-    dpath = f"{form_object['file_name_normalized']}"
+    Only absolute paths are used, the working directory is never changed, so this is safe to call
+    from several threads at once.
+
+    Args:
+        dest_folder (str): The destination base folder.
+        form_object (dict): The file object, see form_folder_paths.
+        copy_source (bool): Copy form_object['abs_path'] to "source_form" when True.
+
+    Returns:
+        dict: The paths returned by form_folder_paths.
+    """
+    paths = form_folder_paths(dest_folder, form_object)
+    for name in FORM_SUBFOLDERS:
+        os.makedirs(paths[name], exist_ok=True)
+    if copy_source and form_object.get('abs_path', None):
+        shutil.copy(form_object['abs_path'], paths['source_file'])
+    return paths
+
+
+def create_form_folder(dest_folder: str, form_object: Dict):
     if form_object.get('abs_path', None):
-        if not os.path.exists(f'{sub_folder}/{dpath}'):
-            os.makedirs(f'{sub_folder}/{dpath}')
-        os.chdir(f'{sub_folder}/{dpath}')
-
-        if not os.path.exists('source_form'):
-            os.makedirs('source_form')
-        # copy source file to dest folder in dedicated subfolder "source_form"
-
-        # create folder for store converted images
-        if not os.path.exists('page_images'):
-            os.makedirs('page_images')
-
-        # create folder for thumbnails
-        if not os.path.exists('page_thumbnails'):
-            os.makedirs('page_thumbnails')
-
-        # create folder for experiments
-        if not os.path.exists('experiments'):
-            os.makedirs('experiments')
-
-        # create folder for features
-        if not os.path.exists('features'):
-            os.makedirs('features')
-
-        # make a copy of the source form to destination form folder
-        src = form_object['abs_path']
-        dst = f"{sub_folder}/{dpath}/source_form/{form_object['file_name_normalized']}{form_object['extension']}"
-        shutil.copy(src, dst)
-    os.chdir(s)
-    return dpath
-
-
-def generate_images_from_pdf(srs_pdf_path: str, dest_folder: str, props={}):
-    convert_from_path(srs_pdf_path,
-                      dpi=props.get('DPI', 250),
-                      output_folder=dest_folder,
-                      grayscale=True,
-                      output_file=props.get('fname', 'cytora_init'),
-                      fmt="png"
-                      )
-    form_meta = {
+        materialize_form_folder(dest_folder, form_object)
+    else:
+        os.makedirs(f"{dest_folder}/{form_object['root_path']}", exist_ok=True)
+    return form_object['file_name_normalized']
+
+
+def generate_images_from_pdf(srs_pdf_path: str, dest_folder: str, props={}, pages: List[int] = None,
+                             progress: RasterProgress = None):
+    """Rasterises the PDF into dest_folder with pdf2image, in page windows rendered in parallel.
+
+    The pages are split into windows of props['chunk_pages'] pages, each one a pdftoppm run of
+    its own, props['raster_workers'] of them at a time. pdftoppm holds one page raster at a time,
+    so each running window reserves the raster size of its largest page out of
+    props['max_raster_memory'] bytes; windows wait until theirs fits. paths_only keeps the pages
+    out of this process, they are only written to dest_folder.
+
+    Args:
+        srs_pdf_path (str): The PDF.
+        dest_folder (str): The page_thumbnails folder.
+        props (dict): 'DPI', 'fname', 'timeout' (seconds, per window), 'chunk_pages',
+            'raster_workers' and 'max_raster_memory'.
+        pages (list): Only rasterise these 1 based page numbers, all pages when None.
+        progress (RasterProgress): Windows already rendered are skipped, every finished window is recorded.
+    """
+    dpi = props.get('DPI', 250)
+    raster_bytes = page_raster_bytes(srs_pdf_path, dpi)
+    if pages is None:
+        pages = range(1, len(raster_bytes) + 1)
+    windows = [w for w in page_windows(pages, props.get('chunk_pages', 20)) if progress is None or w not in progress]
+    budget = MemoryBudget(props.get('max_raster_memory', 1 << 30))
+
+    def render(window):
+        first_page, last_page = window
+        with budget.reserve(max(raster_bytes[first_page - 1: last_page])):
+            # a timeout makes pdf2image kill a hung pdftoppm instead of blocking the worker forever
+            convert_from_path(srs_pdf_path,
+                              dpi=dpi,
+                              output_folder=dest_folder,
+                              first_page=first_page,
+                              last_page=last_page,
+                              grayscale=True,
+                              output_file=props.get('fname', 'cytora_init'),
+                              fmt="png",
+                              paths_only=True,
+                              timeout=props.get('timeout', None)
+                              )
+        if progress is not None:
+            progress.mark(window)
+
+    with ThreadPoolExecutor(max_workers=props.get('raster_workers', 2)) as executor:
+        # list() re-raises the first failed window, after the others have finished
+        list(executor.map(render, windows))
+    return empty_form_meta()
+
+
+def generate_images_with_fitz(srs_pdf_path: str, dest_folder: str, page_stats: PageStats, props={},
+                              pages: List[int] = None, progress: RasterProgress = None, ocr_folder: str = None):
+    """Rasterises the PDF into dest_folder in process with PyMuPDF, in the windows generate_images_from_pdf uses.
+
+    Every page is handed over as an array before it is dropped: to page_stats, and when ocr_folder
+    is given to Tesseract, which writes ``ocr_folder/<page>.json`` for every page not triaged blank
+    or near blank (the layout ocr_form_folders uses, so it skips those pages later). Only one page raster is
+    alive at a time, so the windows only serve progress; max_raster_memory doesn't apply.
+
+    Args:
+        srs_pdf_path (str): The PDF.
+        dest_folder (str): The page_thumbnails folder.
+        page_stats (PageStats): Gets every rendered page.
+        props (dict): 'DPI', 'fname', 'chunk_pages', 'triage_thresholds', 'ocr_lang' and 'skip_near_blank'
+            (False OCRs near blank pages too).
+        pages (list): Only rasterise these 1 based page numbers, all pages when None.
+        progress (RasterProgress): Windows already rendered are skipped, every finished window is recorded.
+        ocr_folder (str): Where the Tesseract responses go, no OCR when None.
+    """
+    if pages is None:
+        pages = range(1, page_count(srs_pdf_path) + 1)
+    if ocr_folder is not None:
+        # not imported at the top, ocr_engines brings in the AWS clients
+        from ocr_engines import tesseract_response
+    thresholds = triage_thresholds(**props.get('triage_thresholds', {}))
+    for window in page_windows(pages, props.get('chunk_pages', 20)):
+        if progress is not None and window in progress:
+            continue
+        for _, path, pixels in rasterise_pdf(srs_pdf_path, dest_folder, dpi=props.get('DPI', 250),
+                                             fname=props.get('fname', 'cytora_init'),
+                                             first_page=window[0], last_page=window[1]):
+            name = os.path.basename(path)
+            page_stats.add(name, pixels)
+            if ocr_folder is None:
+                continue
+            triage = triage_histogram(page_stats.triage_histograms[name], thresholds['ink_delta'],
+                                      thresholds['blank_ink_ratio'], thresholds['near_blank_ink_ratio'])
+            if triage['triage'] not in skipped_triage(skip_near_blank=props.get('skip_near_blank', True)):
+                with open(os.path.join(ocr_folder, f"{os.path.splitext(name)[0]}.json"), 'w') as f:
+                    json.dump(tesseract_response(pixels, lang=props.get('ocr_lang', 'eng')), f)
+        if progress is not None:
+            progress.mark(window)
+    return empty_form_meta()
+
+
+def empty_form_meta() -> Dict:
+    return {
         'num_pages': 0,
         'pages_extent': {},
         'pages_hist': {},
         'pages_': {}
     }
-    return form_meta
 
 
 def get_thumbnails(arr: List, uri: str):
@@ -299,26 +502,90 @@ def get_df(arr: List):
     return d
 
 
-def process_email(el, base_destination, suffix):
+def prepare_form(el, base_destination, suffix):
+    # el['completed_stages'] may be seeded from the processing manifest, finished stages are skipped
     el['file_name_normalized'] = filename_normalizer(el['file_name'], suffix)
-    el['dpath'] = create_form_folder(base_destination, el)
+    completed = el.setdefault('completed_stages', [])
+    if 'copied' in completed:
+        el['dpath'] = el['file_name_normalized']
+    else:
+        el['dpath'] = create_form_folder(base_destination, el)
+        completed.append('copied')
 
-    if suffix in ('.doc', '.docx', '.odt'):
+
+def render_form(el, base_destination, suffix, props=None):
+    if props is None:
+        props = {'DPI': 300}
+    completed = el.setdefault('completed_stages', [])
+
+    if 'converted' not in completed and suffix in OFFICE_EXTENSIONS:
         # s = time.perf_counter()
         # srs = pathlib.PurePath(el['root_path']).name
         srs = el['root_path']
         srs_file = f"{base_destination}/{srs}/{el['dpath']}/source_form/{el['dpath']}{suffix}"
         dst_file = f"{base_destination}/{srs}/{el['dpath']}/source_form/{el['dpath']}.pdf"
-        convert(srs_file, dst_file)
+        if props.get('office_pool', True):
+            get_office_pool(timeout=props.get('timeout', 120)).convert(srs_file, dst_file)
+        else:
+            convert(srs_file, dst_file, timeout=props.get('timeout', None))
         # print(f'processing time is {time.perf_counter() - s} seconds')
-
-    try:
-        sub = el['root_path']
-        el['imagery'] = generate_images_from_pdf(
-            f"{base_destination}/{sub}/{el['dpath']}/source_form/{el['file_name_normalized']}.pdf",
-            f"{base_destination}/{sub}/{el['dpath']}/page_thumbnails", {'DPI': 300})
-    except Exception as ex:
-        el['error'] = str(ex)
+    if 'converted' not in completed:
+        completed.append('converted')
+
+    page_stats = PageStats()
+    if 'rasterised' in completed:
+        el['imagery'] = empty_form_meta()
+        if props.get('text_layer', False):
+            # a resumed form keeps its text layer pages, they count towards num_pages
+            sub = el['root_path']
+            el['text_layer'] = read_text_layer(
+                f"{base_destination}/{sub}/{el['dpath']}/source_form/{el['file_name_normalized']}.pdf",
+                f"{base_destination}/{sub}/{el['dpath']}/text_layer")
+    else:
+        try:
+            sub = el['root_path']
+            thumbnails = f"{base_destination}/{sub}/{el['dpath']}/page_thumbnails"
+            pdf_path = f"{base_destination}/{sub}/{el['dpath']}/source_form/{el['file_name_normalized']}.pdf"
+            rasteriser = props.get('rasteriser', 'pdf2image')
+            # with the fitz rasteriser and props['ocr'] == 'tesseract' the pages are OCRd from memory
+            ocr_folder = None
+            if rasteriser == 'fitz' and props.get('ocr') == 'tesseract':
+                ocr_folder = f"{base_destination}/{sub}/{el['dpath']}/{TESSERACT_RESULT_FOLDER}"
+                os.makedirs(ocr_folder, exist_ok=True)
+            # the windows rendered before an interruption are kept, as long as the source and settings match
+            progress = RasterProgress(
+                f"{base_destination}/{sub}/{el['dpath']}/features/{RASTERISE_PROGRESS_FILE}",
+                raster_source(pdf_path, rasteriser=rasteriser, dpi=props.get('DPI', 250),
+                              fname=props.get('fname', 'cytora_init'), chunk_pages=props.get('chunk_pages', 20),
+                              text_layer=props.get('text_layer', False), ocr=ocr_folder is not None))
+            if not progress.done:
+                # pages left over from an earlier version of the source form must not be mixed in
+                for folder in (thumbnails, ocr_folder):
+                    for f in os.listdir(folder) if folder else []:
+                        os.remove(os.path.join(folder, f))
+            raster_pages = None
+            if props.get('text_layer', False):
+                # born digital pages keep their own text (text_layer/), only the rest is rasterised for OCR
+                text_layer = extract_text_layer(pdf_path, f"{base_destination}/{sub}/{el['dpath']}/text_layer",
+                                                fname=props.get('fname', 'cytora_init'),
+                                                **props.get('text_layer_thresholds', {}))
+                raster_pages = text_layer['raster_pages']
+                el['text_layer'] = {'num_pages': text_layer['num_pages'], 'text_pages': text_layer['text_pages'],
+                                    'raster_pages': raster_pages}
+            if rasteriser == 'fitz':
+                # rendered in process, every page's histogram (and OCR) is taken before its pixels are dropped
+                el['imagery'] = generate_images_with_fitz(pdf_path, thumbnails, page_stats, props, pages=raster_pages,
+                                                          progress=progress, ocr_folder=ocr_folder)
+                progress.finish()
+            elif raster_pages != []:
+                el['imagery'] = generate_images_from_pdf(pdf_path, thumbnails, props, pages=raster_pages,
+                                                         progress=progress)
+                progress.finish()
+            else:
+                el['imagery'] = empty_form_meta()
+            completed.append('rasterised')
+        except Exception as ex:
+            el['error'] = str(ex)
 
     # get thumbnails
     p = f"{base_destination}{el['root_path']}/{el['dpath']}/page_thumbnails"
@@ -327,7 +594,8 @@ def process_email(el, base_destination, suffix):
 
     # get num pages
     try:
-        el['imagery']['num_pages'] = len(el['img_files_thumbnails'])
+        text_pages = el.get('text_layer', {}).get('text_pages', [])
+        el['imagery']['num_pages'] = len(el['img_files_thumbnails']) + len(text_pages)
     except Exception as ex:
         print(ex)
         print(el)
@@ -340,26 +608,87 @@ def process_email(el, base_destination, suffix):
         print(el)
 
     # augment object
+    if not el['img_files_thumbnails']:
+        # every page came from the text layer (or the form has none), there is no image to describe;
+        # a failed rasterisation is retried on the next run instead
+        if 'rasterised' in completed:
+            completed.append('stats')
+        return
     try:
-        f_page = el['img_files_thumbnails'][0]
-        p = f"{base_destination}{el['root_path']}/{el['dpath']}/page_thumbnails/{f_page}"
-        first_page_image = io.imread(p)
-        el['first_page_height'], el['first_page_width'], el['first_page_layers'] = first_page_image.shape
-        #el['first_page_hist'], el['first_page_hist_centers'] = histogram(first_page_image)
-        el['shannon_entropy_2'] = shannon_entropy(first_page_image, base=2)
-        el['img_mean'] = np.mean(first_page_image)
-        el['img_median'] = np.median(first_page_image)
-        el['img_std'] = np.std(first_page_image)
-        el['img_variance'] = np.var(first_page_image)
-        el['img_average'] = np.average(first_page_image)
+        # one histogram per page gives all the statistics, for every page; features/page_stats.json
+        # has them all and the meta keeps the first page's fields
+        form_root = f"{base_destination}{el['root_path']}/{el['dpath']}"
+        for f_page in el['img_files_thumbnails']:
+            if f_page not in page_stats:
+                page_stats.add_file(f_page, f"{form_root}/page_thumbnails/{f_page}")
+        pages = page_stats.write(f"{form_root}/features")
+        el.update(first_page_fields(pages[el['img_files_thumbnails'][0]]))
+        # blank separators and near empty fax covers are kept out of OCR (near blank ones only by default), see
+        # features/page_triage.json
+        thresholds = triage_thresholds(**props.get('triage_thresholds', {}))
+        el['page_triage'] = write_page_triage(
+            f"{form_root}/features",
+            page_stats.triage(thresholds['ink_delta'], thresholds['blank_ink_ratio'],
+                              thresholds['near_blank_ink_ratio']),
+            thresholds)
+        completed.append('stats')
     except Exception as ex:
         print(ex)
         print(el)
 
 
-def processing(base_destination: str, base_uri: str, suffix: str):
+def process_email(el, base_destination, suffix, props=None):
+    prepare_form(el, base_destination, suffix)
+    render_form(el, base_destination, suffix, props)
+
+
+def write_meta(el: Dict, base_destination: str):
+    meta_file = f"{base_destination}{el['root_path']}/{el['file_name_normalized']}_meta.json"
+    with open(meta_file, 'w') as outfile:
+        json.dump(el, outfile)
+
+
+def open_manifest(base_destination: str, doc_files: List, suffix: str):
+    """Opens the processing manifest of base_destination and drops the files that are fully processed.
+
+    The remaining files get their 'completed_stages' seeded from the manifest, so process_email
+    only redoes the stages after the last one that is still valid.
+
+    Args:
+        base_destination (str): The folder holding the form folders and the manifest.
+        doc_files (list): The file objects from get_suff_files_list_of_objects.
+        suffix (str): The attachment extension being processed.
+
+    Returns:
+        tuple: The open ProcessingManifest and the list of file objects still to process.
+    """
+    manifest = ProcessingManifest.for_destination(base_destination)
+    todo = []
+    for el in doc_files:
+        completed = manifest.completed_stages(el['abs_path'])
+        meta_file = f"{base_destination}{el['root_path']}/{filename_normalizer(el['file_name'], suffix)}_meta.json"
+        if len(completed) == len(STAGES) and os.path.exists(meta_file):
+            if el.get('duplicates'):
+                # duplicates that appeared since the last run still need their meta JSON
+                with open(meta_file) as f:
+                    done_el = json.load(f)
+                done_el['duplicates'] = el['duplicates']
+                fan_out_meta(done_el, base_destination, suffix)
+            continue
+        el['completed_stages'] = [stage for stage in completed if stage != 'stats']
+        todo.append(el)
+    print(f'{len(doc_files) - len(todo)} of {len(doc_files)} files are already processed')
+    return manifest, todo
+
+
+def processing(base_destination: str, base_uri: str, suffix: str, resume: bool = False, dedupe: bool = False):
     doc_files = get_suff_files_list_of_objects(base_uri, suffix)
     print(len(doc_files))
+    if dedupe:
+        doc_files = dedupe_doc_files(doc_files)
+    manifest = None
+    if resume:
+        manifest, doc_files = open_manifest(base_destination, doc_files, suffix)
     ss = time.perf_counter()
 
     for el in doc_files:
@@ -367,13 +696,220 @@ def processing(base_destination: str, base_uri: str, suffix: str):
         try:
 
             process_email(el, base_destination, suffix)
-            meta_file = f"{base_destination}{el['root_path']}/{el['file_name_normalized']}_meta.json"
-            with open(meta_file, 'w') as outfile:
-                json.dump(el, outfile)
+            fan_out_meta(el, base_destination, suffix)
+            write_meta(el, base_destination)
         except Exception as ex:
             print(ex)
+        if manifest:
+            manifest.mark(el['abs_path'], el.get('completed_stages', []))
         print(f"file {el['root_path']}-{el['file_name_normalized']} has been processed for ~ {time.perf_counter() - s} seconds")
     print(f"overall execution of the {suffix} costs ~ {time.perf_counter() - ss} seconds")
+    if manifest:
+        manifest.close()
+
+
+def _process_email_task(el: Dict, base_destination: str, suffix: str, props: Dict) -> Dict:
+    # runs inside a pool worker, so every failure is turned into data instead of an exception
+    s = time.perf_counter()
+    try:
+        process_email(el, base_destination, suffix, props)
+        fan_out_meta(el, base_destination, suffix)
+        write_meta(el, base_destination)
+    except Exception as ex:
+        el['error'] = str(ex)
+    el['exec_time_seconds'] = time.perf_counter() - s
+    return el
+
+
+def _render_form_task(el: Dict, base_destination: str, suffix: str, props: Dict) -> Dict:
+    s = time.perf_counter()
+    try:
+        render_form(el, base_destination, suffix, props)
+        fan_out_meta(el, base_destination, suffix)
+        write_meta(el, base_destination)
+    except Exception as ex:
+        el['error'] = str(ex)
+    el['exec_time_seconds'] = el.get('exec_time_seconds', 0) + time.perf_counter() - s
+    return el
+
+
+def processing_parallel(base_destination: str, base_uri: str, suffix: str, workers: int = None,
+                        max_in_flight: int = None, timeout: int = 600, props: Dict = None,
+                        resume: bool = False, dedupe: bool = False) -> List:
+    """Runs process_email over a process pool.
+
+    At most ``max_in_flight`` files are submitted at once, so the pool never holds the whole folder
+    in its queue. ``timeout`` (seconds) is handed to pdf2image and the LibreOffice pool, which kill
+    a hung pdftoppm or soffice. If a worker dies hard (segfault, OOM kill) the pool is rebuilt and
+    the files it was holding are rerun one at a time; a file that crashes its worker while running
+    alone is retried once before being recorded with an error.
+
+    Args:
+        base_destination (str): The folder the form folders and meta JSON files are written to.
+        base_uri (str): The folder scanned for attachments.
+        suffix (str): The attachment extension to process, e.g. '.pdf'.
+        workers (int): Number of worker processes, os.cpu_count() if not passed.
+        max_in_flight (int): Maximum number of submitted but unfinished files, 2 * workers if not passed.
+        timeout (int): Rasterisation timeout in seconds per page window, and office conversion timeout.
+        props (dict): Rasterisation properties passed to process_email.
+        resume (bool): Skip the stages the processing manifest records as done.
+        dedupe (bool): Process each distinct content once and fan the meta JSON out to its duplicates.
+
+    Returns:
+        list: The processed file objects, in completion order.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * workers
+    props = dict(props or {'DPI': 300})
+    props.setdefault('timeout', timeout)
+
+    doc_files = get_suff_files_list_of_objects(base_uri, suffix)
+    if dedupe:
+        doc_files = dedupe_doc_files(doc_files)
+    manifest = None
+    if resume:
+        manifest, doc_files = open_manifest(base_destination, doc_files, suffix)
+    total = len(doc_files)
+    print(total)
+
+    pending = list(reversed(doc_files))
+    # files that were in flight when a worker crashed; they run one at a time so a crash is pinned on its file
+    isolated = []
+    attempts = {}
+    done = []
+    ss = time.perf_counter()
+
+    def record(res):
+        done.append(res)
+        if manifest:
+            manifest.mark(res['abs_path'], res.get('completed_stages', []))
+
+    while pending or isolated:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        in_flight = {}
+        try:
+            while pending or isolated or in_flight:
+                if isolated:
+                    if not in_flight:
+                        future = executor.submit(_process_email_task, isolated[-1], base_destination, suffix, props)
+                        in_flight[future] = isolated.pop()
+                else:
+                    while pending and len(in_flight) < max_in_flight:
+                        # the file only leaves pending once it is in flight, a failing submit loses nothing
+                        future = executor.submit(_process_email_task, pending[-1], base_destination, suffix, props)
+                        in_flight[future] = pending.pop()
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    # result() first: a broken pool raises here and the file must still be in in_flight
+                    res = future.result()
+                    del in_flight[future]
+                    record(res)
+                    print(f"{len(done)}/{total} file {res['root_path']}-{res.get('file_name_normalized')} "
+                          f"has been processed for ~ {res['exec_time_seconds']} seconds")
+        except BrokenProcessPool:
+            crashed = list(in_flight.values())
+            if len(crashed) > 1:
+                # any of them may have killed the worker, none of them spends its retry on it
+                isolated.extend(crashed)
+            else:
+                # running alone, this file crashed the worker; it is retried once
+                for el in crashed:
+                    key = el['abs_path']
+                    attempts[key] = attempts.get(key, 0) + 1
+                    if attempts[key] > 1:
+                        el['error'] = 'worker process crashed'
+                        record(el)
+                    else:
+                        isolated.append(el)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    elapsed = time.perf_counter() - ss
+    errors = len([el for el in done if el.get('error')])
+    print(f"overall execution of the {suffix} costs ~ {elapsed} seconds, "
+          f"{len(done) / elapsed if elapsed else 0:.2f} files/sec with {workers} workers, {errors} errors")
+    if manifest:
+        manifest.close()
+    return done
+
+
+def processing_threaded(base_destination: str, base_uri: str, suffix: str, io_workers: int = 4,
+                        render_workers: int = None, max_in_flight: int = None, props: Dict = None,
+                        resume: bool = False, dedupe: bool = False) -> List:
+    """Runs the folder materialisation and the rendering of the forms in two thread pools.
+
+    Copying a source form into its form folder is disk bound, LibreOffice and pdftoppm run as
+    subprocesses, so neither holds the GIL for long. The PyMuPDF calls (page sizes, the text layer,
+    the fitz rasteriser) run in the render threads, one at a time under pdf_rasteriser.FITZ_LOCK.
+    Each file is copied in the io pool and handed to the render pool as soon as its copy is done,
+    so copies of the next forms overlap with the rasterisation of the previous ones.
+
+    Args:
+        base_destination (str): The folder the form folders and meta JSON files are written to.
+        base_uri (str): The folder scanned for attachments.
+        suffix (str): The attachment extension to process, e.g. '.pdf'.
+        io_workers (int): Number of threads copying source forms.
+        render_workers (int): Number of threads converting and rasterising, os.cpu_count() if not passed.
+        max_in_flight (int): Maximum number of files being copied or rendered, 2 * (io + render workers) if not passed.
+        props (dict): Rasterisation properties passed to render_form.
+        resume (bool): Skip the stages the processing manifest records as done.
+        dedupe (bool): Process each distinct content once and fan the meta JSON out to its duplicates.
+
+    Returns:
+        list: The processed file objects, in completion order.
+    """
+    render_workers = render_workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * (io_workers + render_workers)
+    props = props or {'DPI': 300}
+    if suffix in OFFICE_EXTENSIONS and props.get('office_pool', True):
+        # one LibreOffice instance per render thread, they share this process' pool
+        get_office_pool(render_workers, props.get('timeout', 120))
+
+    doc_files = get_suff_files_list_of_objects(base_uri, suffix)
+    if dedupe:
+        doc_files = dedupe_doc_files(doc_files)
+    manifest = None
+    if resume:
+        manifest, doc_files = open_manifest(base_destination, doc_files, suffix)
+    total = len(doc_files)
+    print(total)
+
+    pending = list(reversed(doc_files))
+    done = []
+    in_flight = {}
+    ss = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=io_workers) as io_pool, \
+            ThreadPoolExecutor(max_workers=render_workers) as render_pool:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_in_flight:
+                el = pending.pop()
+                el['exec_time_seconds'] = 0
+                in_flight[io_pool.submit(prepare_form, el, base_destination, suffix)] = ('copy', el)
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, el = in_flight.pop(future)
+                if stage == 'copy':
+                    try:
+                        future.result()
+                    except Exception as ex:
+                        el['error'] = str(ex)
+                        done.append(el)
+                        continue
+                    in_flight[render_pool.submit(_render_form_task, el, base_destination, suffix, props)] = ('render', el)
+                else:
+                    done.append(future.result())
+                    if manifest:
+                        manifest.mark(el['abs_path'], el.get('completed_stages', []))
+                    print(f"{len(done)}/{total} file {el['root_path']}-{el['file_name_normalized']} "
+                          f"has been processed for ~ {el['exec_time_seconds']} seconds")
+
+    elapsed = time.perf_counter() - ss
+    print(f"overall execution of the {suffix} costs ~ {elapsed} seconds, "
+          f"{len(done) / elapsed if elapsed else 0:.2f} files/sec")
+    if manifest:
+        manifest.close()
+    return done
 
 
 if __name__ == '__main__':
@@ -403,6 +939,6 @@ if __name__ == '__main__':
 
     suffix = '.pdf'
     suff = suffix[1:]
-    processing(base_destination, base_uri, suffix)
-
-
+    # processing_threaded(base_destination, base_uri, suffix, io_workers=4, render_workers=8)
+    processing(base_destination, base_uri, suffix, resume=True, dedupe=True)
+    # processing_parallel(base_destination, base_uri, suffix, workers=8)
@@ -0,0 +1,123 @@
+import json
+import os
+import re
+from typing import Dict, List
+
+import fitz
+
+from pdf_rasteriser import FITZ_LOCK, page_file_name
+from textract_blocks import words_to_response
+
+# a page is served from its text layer when it has at least this many words and characters ...
+MIN_WORDS = 20
+MIN_CHARS = 100
+# ... whose word boxes cover at least this share of the page ...
+MIN_TEXT_COVERAGE = 0.01
+# ... no more than this share of unmappable glyphs (fonts without a usable ToUnicode map) ...
+MAX_GARBAGE_RATIO = 0.05
+# ... and images cover less than this share of the page (a scan with a few typed words on top isn't)
+MAX_IMAGE_COVERAGE = 0.5
+
+# cytora_init0001-07.json -> page 7
+PAGE_NAME = re.compile(r'-(\d+)\.json$')
+
+
+def page_text_coverage(page: 'fitz.Page') -> Dict:
+    """Measures how much usable text a PDF page's text layer holds.
+
+    Returns:
+        dict: 'words', 'chars', 'garbage_ratio' (share of U+FFFD characters), 'text_coverage' and
+            'image_coverage' (shares of the page area covered by word and image boxes).
+    """
+    words = page.get_text('words')
+    area = abs(page.rect) or 1.0
+    text = ''.join(w[4] for w in words)
+    image_area = 0.0
+    for info in page.get_image_info():
+        image_area += abs(fitz.Rect(info['bbox']) & page.rect)
+    return {
+        'words': len(words),
+        'chars': len(text),
+        'garbage_ratio': text.count('\ufffd') / len(text) if text else 0.0,
+        'text_coverage': sum(abs(fitz.Rect(w[:4])) for w in words) / area,
+        'image_coverage': min(1.0, image_area / area),
+    }
+
+
+def has_text_layer(coverage: Dict, min_words: int = MIN_WORDS, min_chars: int = MIN_CHARS,
+                   min_text_coverage: float = MIN_TEXT_COVERAGE, max_garbage_ratio: float = MAX_GARBAGE_RATIO,
+                   max_image_coverage: float = MAX_IMAGE_COVERAGE) -> bool:
+    return (coverage['words'] >= min_words and coverage['chars'] >= min_chars
+            and coverage['text_coverage'] >= min_text_coverage
+            and coverage['garbage_ratio'] <= max_garbage_ratio and coverage['image_coverage'] < max_image_coverage)
+
+
+def text_layer_response(page: 'fitz.Page') -> Dict:
+    """A PDF page's text layer in the Textract block schema, words grouped into LINEs as fitz groups them."""
+    words = [(x0, y0, x1, y1, text, (block_no, line_no), 100.0)
+             for x0, y0, x1, y1, text, block_no, line_no, _ in page.get_text('words', sort=True)]
+    rect = page.rect
+    response = words_to_response(words, rect.width, rect.height)
+    response['Engine'] = 'text_layer'
+    return response
+
+
+def extract_text_layer(pdf_path: str, dest_folder: str, fname: str = 'cytora_init', **thresholds) -> Dict:
+    """Writes the text layer of every text rich page and tells which pages still need rasterising.
+
+    Each text rich page's response goes to ``dest_folder/<page name>.json``, the page name being the
+    one its PNG would get in page_thumbnails, so OCR results and text layer results line up. The
+    folder is emptied first.
+
+    Args:
+        pdf_path (str): The PDF.
+        dest_folder (str): The form's text_layer folder.
+        fname (str): The page file name prefix, as used for the thumbnails.
+        thresholds: Overrides for has_text_layer's min_words, min_chars, min_text_coverage,
+            max_garbage_ratio and max_image_coverage.
+
+    Returns:
+        dict: 'num_pages', 'text_pages' and 'raster_pages' (1 based page numbers) and 'coverage' per page.
+    """
+    os.makedirs(dest_folder, exist_ok=True)
+    # results left over from an earlier version of the source form must not be mixed in
+    for f in os.listdir(dest_folder):
+        os.remove(os.path.join(dest_folder, f))
+    text_pages: List[int] = []
+    raster_pages: List[int] = []
+    coverage = {}
+    # called from the render threads of processing_threaded
+    with FITZ_LOCK, fitz.open(pdf_path) as doc:
+        num_pages = doc.page_count
+        for page_number, page in enumerate(doc, start=1):
+            coverage[page_number] = page_text_coverage(page)
+            if not has_text_layer(coverage[page_number], **thresholds):
+                raster_pages.append(page_number)
+                continue
+            name = page_file_name(fname, page_number, num_pages).rsplit('.', 1)[0]
+            with open(os.path.join(dest_folder, f'{name}.json'), 'w') as f:
+                json.dump(text_layer_response(page), f)
+            text_pages.append(page_number)
+    return {'num_pages': num_pages, 'text_pages': text_pages, 'raster_pages': raster_pages, 'coverage': coverage}
+
+
+def read_text_layer(pdf_path: str, dest_folder: str) -> Dict:
+    """What extract_text_layer returned for a form, from the page responses it left in dest_folder.
+
+    Used when the form's rasterisation is already done (a resumed run) and only the stages after
+    it are redone.
+
+    Returns:
+        dict: 'num_pages', 'text_pages' and 'raster_pages' (1 based page numbers).
+    """
+    with FITZ_LOCK, fitz.open(pdf_path) as doc:
+        num_pages = doc.page_count
+    text_pages = []
+    if os.path.isdir(dest_folder):
+        for f in os.listdir(dest_folder):
+            m = PAGE_NAME.search(f)
+            if m:
+                text_pages.append(int(m.group(1)))
+    text_pages.sort()
+    raster_pages = sorted(set(range(1, num_pages + 1)) - set(text_pages))
+    return {'num_pages': num_pages, 'text_pages': text_pages, 'raster_pages': raster_pages}
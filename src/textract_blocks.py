@@ -0,0 +1,178 @@
+import os
+import re
+import threading
+import uuid
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+PAGE_NUMBER = re.compile(r'-(\d+)$')
+
+
+def block_schema():
+    return pa.schema([
+        ('document', pa.string()),
+        ('page', pa.int32()),
+        ('block_id', pa.string()),
+        ('block_type', pa.dictionary(pa.int8(), pa.string())),
+        ('entity_type', pa.dictionary(pa.int8(), pa.string())),
+        ('text', pa.string()),
+        ('confidence', pa.float32()),
+        ('bbox_left', pa.float32()),
+        ('bbox_top', pa.float32()),
+        ('bbox_width', pa.float32()),
+        ('bbox_height', pa.float32()),
+        ('relationships', pa.list_(pa.struct([('type', pa.string()), ('ids', pa.list_(pa.string()))]))),
+    ])
+
+
+def page_number(document: str) -> Optional[int]:
+    """The page number in a page_thumbnails file name, e.g. 12 for ``cytora_init0001-12.png``."""
+    m = PAGE_NUMBER.search(document.split('/')[-1].split('.')[0])
+    return int(m.group(1)) if m else None
+
+
+def block_rows(document: str, response: Dict) -> Dict[str, List]:
+    """Flattens a Textract response into columns, one row per block."""
+    page = page_number(document)
+    columns: Dict[str, List] = {name: [] for name in (
+        'document', 'page', 'block_id', 'block_type', 'entity_type', 'text', 'confidence',
+        'bbox_left', 'bbox_top', 'bbox_width', 'bbox_height', 'relationships')}
+    for block in response['Blocks']:
+        box = block['Geometry']['BoundingBox']
+        columns['document'].append(document)
+        columns['page'].append(page if page is not None else block.get('Page'))
+        columns['block_id'].append(block['Id'])
+        columns['block_type'].append(block['BlockType'])
+        columns['entity_type'].append(block['EntityTypes'][0] if block.get('EntityTypes') else None)
+        columns['text'].append(block.get('Text'))
+        columns['confidence'].append(block.get('Confidence'))
+        columns['bbox_left'].append(box['Left'])
+        columns['bbox_top'].append(box['Top'])
+        columns['bbox_width'].append(box['Width'])
+        columns['bbox_height'].append(box['Height'])
+        columns['relationships'].append([{'type': r['Type'], 'ids': r['Ids']}
+                                         for r in block.get('Relationships', [])])
+    return columns
+
+
+class BlockWriter:
+    """Collects Textract blocks from many pages and writes them as Parquet, one row per block.
+
+    Files go to ``root/source_folder=<partition>/part-<uuid>.parquet`` (hive partitioning), so
+    ``pyarrow.dataset.dataset(root, partitioning='hive')`` or pandas/duckdb read them back and only
+    load the columns asked for. Rows are buffered and written every ``rows_per_file`` rows, and
+    ``add`` can be called from the run_pages worker threads.
+
+    Args:
+        root (str): The dataset folder.
+        partition (str): The source folder of the pages, e.g. the S3 prefix the driver lists.
+        rows_per_file (int): Buffered rows that trigger writing a file.
+    """
+
+    def __init__(self, root: str, partition: str, rows_per_file: int = 200_000):
+        if pa is None:
+            raise ImportError('BlockWriter needs pyarrow, pip install pyarrow')
+        self.folder = os.path.join(root, f"source_folder={partition.strip('/').replace('/', '_')}")
+        self.rows_per_file = rows_per_file
+        self.schema = block_schema()
+        self.files: List[str] = []
+        self._columns: Dict[str, List] = {name: [] for name in self.schema.names}
+        self._rows = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, document: str, response: Dict) -> int:
+        """Buffers a page's blocks and returns how many there were."""
+        rows = block_rows(document, response)
+        n = len(rows['block_id'])
+        with self._lock:
+            for name, values in rows.items():
+                self._columns[name].extend(values)
+            self._rows += n
+            if self._rows >= self.rows_per_file:
+                self._flush()
+        return n
+
+    def _flush(self) -> None:
+        if not self._rows:
+            return
+        table = pa.Table.from_pydict(self._columns, schema=self.schema)
+        path = os.path.join(self.folder, f'part-{uuid.uuid4().hex}.parquet')
+        pq.write_table(table, path, compression='zstd')
+        self.files.append(path)
+        self._columns = {name: [] for name in self.schema.names}
+        self._rows = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+
+
+def block_type_counts(blocks: List[Dict]) -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+    for block in blocks:
+        counts[block['BlockType']] = counts.get(block['BlockType'], 0) + 1
+    return counts
+
+
+def textract_geometry(left: float, top: float, width: float, height: float) -> Dict:
+    """A Textract Geometry for an axis aligned box, in page fractions."""
+    return {'BoundingBox': {'Width': width, 'Height': height, 'Left': left, 'Top': top},
+            'Polygon': [{'X': left, 'Y': top}, {'X': left + width, 'Y': top},
+                        {'X': left + width, 'Y': top + height}, {'X': left, 'Y': top + height}]}
+
+
+def words_to_response(words: Sequence[Tuple[float, float, float, float, str, tuple, float]], width: float,
+                      height: float) -> Dict:
+    """Builds a Textract shaped response (PAGE, LINE and WORD blocks) from positioned words.
+
+    Args:
+        words (list): (left, top, right, bottom, text, line key, confidence) per word, in the
+            page's units; words with the same line key make up a LINE, in reading order.
+        width (float): The page width, in the same units.
+        height (float): The page height, in the same units.
+
+    Returns:
+        dict: 'DocumentMetadata' and 'Blocks', page relative geometry and CHILD relationships.
+    """
+    page = {'BlockType': 'PAGE', 'Id': str(uuid.uuid4()), 'Geometry': textract_geometry(0.0, 0.0, 1.0, 1.0),
+            'Relationships': [{'Type': 'CHILD', 'Ids': []}]}
+    lines: Dict[tuple, Dict] = {}
+    word_blocks = []
+    for left, top, right, bottom, text, line_key, confidence in words:
+        word = {'BlockType': 'WORD', 'Id': str(uuid.uuid4()), 'Text': text, 'TextType': 'PRINTED',
+                'Confidence': confidence,
+                'Geometry': textract_geometry(left / width, top / height, (right - left) / width,
+                                              (bottom - top) / height)}
+        word_blocks.append(word)
+        line = lines.setdefault(line_key, {'words': [], 'box': [left, top, right, bottom]})
+        line['words'].append(word)
+        box = line['box']
+        box[0], box[1] = min(box[0], left), min(box[1], top)
+        box[2], box[3] = max(box[2], right), max(box[3], bottom)
+
+    blocks = [page]
+    for line in lines.values():
+        left, top, right, bottom = line['box']
+        block = {'BlockType': 'LINE', 'Id': str(uuid.uuid4()),
+                 'Text': ' '.join(w['Text'] for w in line['words']),
+                 'Confidence': sum(w['Confidence'] for w in line['words']) / len(line['words']),
+                 'Geometry': textract_geometry(left / width, top / height, (right - left) / width,
+                                               (bottom - top) / height),
+                 'Relationships': [{'Type': 'CHILD', 'Ids': [w['Id'] for w in line['words']]}]}
+        page['Relationships'][0]['Ids'].append(block['Id'])
+        blocks.append(block)
+    blocks.extend(word_blocks)
+    return {'DocumentMetadata': {'Pages': 1}, 'Blocks': blocks}
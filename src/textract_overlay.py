@@ -0,0 +1,173 @@
+import hashlib
+import io
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from aws_clients import get_client
+from textract_pipeline import run_pages
+
+
+def result_key(document: str, result_folder: str, ext: str = 'json') -> str:
+    """The S3 key a page's Textract output is stored under, next to its page_thumbnails folder.
+
+    e.g. ``a/b/page_thumbnails/cytora_init0001-1.png`` -> ``a/b/aws_textract_ocr/cytora_init0001-1.json``
+    """
+    dst_folder = '/'.join(document.split('/')[0:-2])
+    return f"{dst_folder}/{result_folder}/{document.split('/')[-1].split('.')[0]}.{ext}"
+
+
+# outline colour of the boxes drawn for each group, SELECTED is filled instead
+BOX_COLOURS = {'KEY': 'red', 'VALUE': 'green', 'TABLE': 'blue', 'CELL': 'yellow', 'LINE': 'blue'}
+
+
+def _geometry_group(block: Dict) -> Optional[str]:
+    block_type = block['BlockType']
+    if block_type == 'KEY_VALUE_SET':
+        return 'KEY' if block['EntityTypes'][0] == 'KEY' else 'VALUE'
+    if block_type == 'SELECTION_ELEMENT':
+        return 'SELECTED' if block['SelectionStatus'] == 'SELECTED' else None
+    if block_type in ('TABLE', 'CELL', 'WORD', 'LINE'):
+        return block_type
+    return None
+
+
+def block_geometry(blocks: List[Dict]) -> Dict[str, Dict[str, np.ndarray]]:
+    """Extracts the geometry of the drawn blocks into arrays, grouped by what is drawn for them.
+
+    Args:
+        blocks (list): Textract blocks.
+
+    Returns:
+        dict: Group (KEY, VALUE, TABLE, CELL, SELECTED, WORD or LINE) to 'boxes', an (n, 4) array of
+            left, top, right, bottom, and 'polygons', an (n, 4, 2) array of x, y, in page fractions.
+    """
+    boxes: Dict[str, List] = {}
+    polygons: Dict[str, List] = {}
+    for block in blocks:
+        group = _geometry_group(block)
+        if group is None:
+            continue
+        box = block['Geometry']['BoundingBox']
+        boxes.setdefault(group, []).append((box['Left'], box['Top'], box['Width'], box['Height']))
+        polygons.setdefault(group, []).append([(p['X'], p['Y']) for p in block['Geometry']['Polygon'][:4]])
+
+    geometry = {}
+    for group, group_boxes in boxes.items():
+        arr = np.asarray(group_boxes, dtype=np.float32)
+        arr[:, 2:] += arr[:, :2]
+        geometry[group] = {'boxes': arr, 'polygons': np.asarray(polygons[group], dtype=np.float32)}
+    return geometry
+
+
+def scale_geometry(geometry: Dict[str, Dict[str, np.ndarray]], width: int,
+                   height: int) -> Dict[str, Dict[str, np.ndarray]]:
+    """Scales the page fractions from block_geometry to pixels, every group in one array operation."""
+    scale = np.array([width, height], dtype=np.float32)
+    return {group: {'boxes': (g['boxes'].reshape(-1, 2, 2) * scale).reshape(-1, 4),
+                    'polygons': g['polygons'] * scale}
+            for group, g in geometry.items()}
+
+
+def draw_blocks(image: Image.Image, blocks: List[Dict]) -> Image.Image:
+    """Draws the Textract blocks onto the page image, in place.
+
+    WORD: green start and red end of the word, LINE: black polygon and blue box, KEY_VALUE_SET: red key
+    and green value boxes, TABLE: blue box, CELL: yellow box, SELECTION_ELEMENT: filled blue when selected.
+    """
+    geometry = scale_geometry(block_geometry(blocks), *image.size)
+    draw = ImageDraw.Draw(image)
+
+    for group in ('KEY', 'VALUE', 'TABLE', 'CELL'):
+        if group in geometry:
+            for box in geometry[group]['boxes'].tolist():
+                draw.rectangle(box, outline=BOX_COLOURS[group])
+    if 'SELECTED' in geometry:
+        for box in geometry['SELECTED']['boxes'].tolist():
+            draw.rectangle(box, fill='blue')
+
+    if 'WORD' in geometry:
+        polygons = geometry['WORD']['polygons']
+        # start (points 0-3) and end (points 1-2) edges of every word, as flat x0, y0, x1, y1 rows
+        for start in polygons[:, [0, 3]].reshape(-1, 4).tolist():
+            draw.line(start, fill='green', width=2)
+        for end in polygons[:, [1, 2]].reshape(-1, 4).tolist():
+            draw.line(end, fill='red', width=2)
+
+    if 'LINE' in geometry:
+        for polygon in geometry['LINE']['polygons'].reshape(-1, 8).tolist():
+            draw.polygon(polygon, outline='black')
+        for box in geometry['LINE']['boxes'].tolist():
+            draw.rectangle(box, outline=BOX_COLOURS['LINE'])
+    return image
+
+
+def render_overlay(bucket: str, document: str, result_folder: str, response: Optional[Dict] = None,
+                   local_dir: Optional[str] = 'results') -> Dict:
+    """Draws a page's Textract blocks over the page image and uploads the PNG next to the JSON result.
+
+    This is the only place the page image is downloaded and decoded, Textract itself reads the page
+    straight from S3.
+
+    Args:
+        bucket (str): The bucket holding the page and its results.
+        document (str): The page's S3 key, in a page_thumbnails folder.
+        result_folder (str): The results folder, aws_textract_ocr or aws_textract_document.
+        response (dict): The Textract response, read back from the stored JSON result when None.
+        local_dir (str): Folder a local copy of the overlay is saved to, None to skip it.
+
+    Returns:
+        dict: The overlay's key, block count and upload state.
+    """
+    s3_client = get_client('s3')
+    if response is None:
+        obj = s3_client.get_object(Bucket=bucket, Key=result_key(document, result_folder))
+        response = json.loads(obj['Body'].read())
+
+    s3_response = s3_client.get_object(Bucket=bucket, Key=document)
+    image = Image.open(io.BytesIO(s3_response['Body'].read()))
+    draw_blocks(image, response['Blocks'])
+
+    in_mem_file = io.BytesIO()
+    image.save(in_mem_file, "PNG")
+    in_mem_file.seek(0)
+    if local_dir:
+        with open(os.path.join(local_dir, f"overlay_{document.split('/')[-1].split('.')[0]}.png"), 'wb') as f:
+            f.write(in_mem_file.getbuffer())
+
+    dst = result_key(document, result_folder, 'png')
+    result = s3_client.put_object(Body=in_mem_file, Bucket=bucket, Key=dst)
+    return {'overlay': dst, 'blocks': len(response['Blocks']),
+            'upload_overlay_state': result.get('ResponseMetadata', {}).get('HTTPStatusCode')}
+
+
+def sample_pages(pages: List[str], rate: float) -> List[str]:
+    """Picks about ``rate`` of the pages, by a hash of the key so every run picks the same ones."""
+    if rate >= 1:
+        return list(pages)
+    return [p for p in pages if int(hashlib.sha1(p.encode()).hexdigest()[:8], 16) < rate * 0x100000000]
+
+
+def render_overlays(bucket: str, pages: List[str], result_folder: str, sample_rate: float = 0.05,
+                    concurrency: int = 8, results_file: Optional[str] = None) -> List[Dict]:
+    """The overlay stage: renders overlays for a sample of already processed pages.
+
+    Runs after (and independently of) the Textract stage, from the JSON results it stored, so pages
+    nobody looks at are never downloaded or decoded.
+
+    Args:
+        pages (list): The S3 keys of the processed pages.
+        result_folder (str): The results folder, aws_textract_ocr or aws_textract_document.
+        sample_rate (float): Fraction of the pages to render, 1 renders all of them.
+        results_file (str): JSON Lines file the overlay stats are appended to, pages in it are skipped.
+
+    Returns:
+        list: The overlay stats of the pages rendered by this run.
+    """
+    sampled = sample_pages(pages, sample_rate)
+    print(f'rendering overlays for {len(sampled)} of {len(pages)} pages')
+    return run_pages(sampled, lambda page: render_overlay(bucket, page, result_folder),
+                     concurrency=concurrency, results_file=results_file)
@@ -0,0 +1,259 @@
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List, Optional
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+
+THROTTLING_ERRORS = {
+    'ThrottlingException',
+    'ProvisionedThroughputExceededException',
+    'LimitExceededException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+}
+
+
+def is_throttling_error(ex: Exception) -> bool:
+    if isinstance(ex, ClientError):
+        return ex.response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+    return type(ex).__name__ in THROTTLING_ERRORS
+
+
+# what botocore's standard retry mode retries besides throttling, with its default attempt count
+TRANSIENT_ERRORS = {
+    'InternalError',
+    'InternalFailure',
+    'InternalServerError',
+    'ServiceUnavailable',
+    'RequestTimeout',
+    'RequestTimeoutException',
+}
+MAX_TRANSIENT_ATTEMPTS = 3
+
+
+def is_transient_error(ex: Exception) -> bool:
+    """Connection errors, timeouts and 5xx responses, worth retrying but not a reason to slow down."""
+    if isinstance(ex, (ConnectionError, HTTPClientError)):
+        return True
+    if isinstance(ex, ClientError):
+        if ex.response.get('Error', {}).get('Code') in TRANSIENT_ERRORS:
+            return True
+        return ex.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+    return False
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    # full jitter, https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class AdaptiveLimiter:
+    """Caps the number of concurrent requests and adapts the cap to throttling (AIMD).
+
+    The cap starts at ``max_concurrency``; every throttling error halves it, and every ``cap``
+    successful calls in a row raise it by one again, up to ``max_concurrency``.
+    """
+
+    def __init__(self, max_concurrency: int, min_concurrency: int = 1):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = max_concurrency
+        self.active = 0
+        self.throttled = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def on_success(self) -> None:
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def on_throttle(self) -> None:
+        with self._cond:
+            self.throttled += 1
+            self._successes = 0
+            self.limit = max(self.min_concurrency, self.limit // 2)
+
+
+def call_with_backoff(fn: Callable, page: str, limiter: AdaptiveLimiter, max_attempts: int = 8) -> Dict:
+    # throttling shrinks the limiter, transient errors (botocore doesn't retry Textract calls, see
+    # aws_clients) are only retried MAX_TRANSIENT_ATTEMPTS times, like botocore's standard mode would
+    transient = 0
+    for attempt in range(max_attempts):
+        try:
+            with limiter:
+                res = fn(page)
+            limiter.on_success()
+            res['attempts'] = attempt + 1
+            return res
+        except Exception as ex:
+            if attempt == max_attempts - 1:
+                raise
+            if is_throttling_error(ex):
+                limiter.on_throttle()
+            elif is_transient_error(ex) and transient < MAX_TRANSIENT_ATTEMPTS - 1:
+                transient += 1
+            else:
+                raise
+            time.sleep(backoff_delay(attempt))
+
+
+def load_completed(results_file: str) -> set:
+    done = set()
+    if results_file and os.path.exists(results_file):
+        with open(results_file) as f:
+            for line in f:
+                res = json.loads(line)
+                if 'err' not in res:
+                    done.add(res['file'])
+    return done
+
+
+def run_pages(pages: List[str], fn: Callable[[str], Dict], concurrency: int = 8, max_attempts: int = 8,
+              results_file: Optional[str] = None) -> List[Dict]:
+    """Runs fn over every page with up to ``concurrency`` calls in flight.
+
+    Throttled calls are retried with jittered exponential backoff while the shared AdaptiveLimiter
+    lowers the number of concurrent calls. Each page's stats are appended to ``results_file`` (JSON
+    Lines) as soon as the page is done, and pages already recorded there without an error are
+    skipped, so an interrupted run can be restarted.
+
+    Args:
+        pages (list): The S3 keys of the pages.
+        fn (callable): Processes one page and returns its stats dict, e.g. process_text_analysis bound
+            to a bucket.
+        concurrency (int): The maximum number of calls in flight.
+        max_attempts (int): Attempts per page before a throttling error is recorded as the page's error;
+            transient errors (connection errors, timeouts, 5xx) get MAX_TRANSIENT_ATTEMPTS of them.
+        results_file (str): JSON Lines file the per-page stats are appended to.
+
+    Returns:
+        list: The stats of the pages processed by this run, in completion order.
+    """
+    done_before = load_completed(results_file)
+    todo = [p for p in pages if p not in done_before]
+    total = len(todo)
+    print(f'{len(pages) - total} of {len(pages)} pages already processed')
+
+    limiter = AdaptiveLimiter(concurrency)
+
+    def task(page):
+        s = time.perf_counter()
+        try:
+            res = call_with_backoff(fn, page, limiter, max_attempts)
+        except Exception as ex:
+            res = {'err': str(ex)}
+        res['file'] = page
+        res['exec_time_seconds'] = time.perf_counter() - s
+        return res
+
+    rr = []
+    s0 = time.perf_counter()
+    pending = list(reversed(todo))
+    in_flight = set()
+    outfile = open(results_file, 'a') if results_file else None
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while pending or in_flight:
+                while pending and len(in_flight) < 2 * concurrency:
+                    in_flight.add(executor.submit(task, pending.pop()))
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    res = future.result()
+                    rr.append(res)
+                    if outfile:
+                        outfile.write(json.dumps(res, default=str) + '\n')
+                        outfile.flush()
+                    print(f"{len(rr)}/{total} processing file {res['file']} cost: {res['exec_time_seconds']} seconds"
+                          f"{' ERROR ' + res['err'] if 'err' in res else ''}")
+    finally:
+        if outfile:
+            outfile.close()
+
+    elapsed = time.perf_counter() - s0
+    print(f'total processing costs: {elapsed} seconds, {len(rr) / elapsed if elapsed else 0:.2f} pages/sec, '
+          f'{limiter.throttled} throttled calls, final concurrency {limiter.limit}')
+    return rr
+
+
+class FakeTextract:
+    """A stand-in Textract client with injected latency and throttling, for exercising run_pages offline.
+
+    Args:
+        latency (float): Seconds every call sleeps.
+        throttle_above (int): Calls made while more than this many are in flight raise ThrottlingException.
+        words (int): Number of WORD blocks in every response.
+    """
+
+    def __init__(self, latency: float = 0.2, throttle_above: int = 10, words: int = 20):
+        self.latency = latency
+        self.throttle_above = throttle_above
+        self.words = words
+        self.calls = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def _call(self, operation: str) -> Dict:
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            throttle = self.in_flight > self.throttle_above
+        try:
+            time.sleep(self.latency)
+            if throttle:
+                raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, operation)
+            return self._response()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _response(self) -> Dict:
+        blocks = [{'BlockType': 'PAGE', 'Id': str(uuid.uuid4()),
+                   'Geometry': {'BoundingBox': {'Width': 1.0, 'Height': 1.0, 'Left': 0.0, 'Top': 0.0},
+                                'Polygon': [{'X': 0.0, 'Y': 0.0}, {'X': 1.0, 'Y': 0.0},
+                                            {'X': 1.0, 'Y': 1.0}, {'X': 0.0, 'Y': 1.0}]}}]
+        for i in range(self.words):
+            left, top = (i % 10) / 10, (i // 10) / 40
+            blocks.append({'BlockType': 'WORD', 'Id': str(uuid.uuid4()), 'Text': f'word{i}', 'Confidence': 99.0,
+                           'Geometry': {'BoundingBox': {'Width': 0.08, 'Height': 0.02, 'Left': left, 'Top': top},
+                                        'Polygon': [{'X': left, 'Y': top}, {'X': left + 0.08, 'Y': top},
+                                                    {'X': left + 0.08, 'Y': top + 0.02},
+                                                    {'X': left, 'Y': top + 0.02}]}})
+        return {'DocumentMetadata': {'Pages': 1}, 'Blocks': blocks,
+                'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def detect_document_text(self, **kwargs) -> Dict:
+        return self._call('DetectDocumentText')
+
+    def analyze_document(self, **kwargs) -> Dict:
+        return self._call('AnalyzeDocument')
+
+
+if __name__ == '__main__':
+    # exercise the driver against the fake client: 200 pages, 0.2s latency, throttling above 10 in flight
+    fake = FakeTextract(latency=0.2, throttle_above=10)
+    pages = [f'fake/page_thumbnails/cytora_init0001-{i}.png' for i in range(200)]
+    for concurrency in (1, 8, 32):
+        run_pages(pages, lambda page: {'blocks': len(fake.detect_document_text(Document={})['Blocks'])},
+                  concurrency=concurrency)
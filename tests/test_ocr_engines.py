@@ -0,0 +1,51 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+pytest.importorskip('boto3')
+pytesseract = pytest.importorskip('pytesseract')
+
+import ocr_engines  # noqa: E402
+
+
+def image_to_data(conf):
+    # two words on one line, a non-word row (-1) and an empty word, as pytesseract.Output.DICT has them
+    def fake(image, lang, config, output_type):
+        return {
+            'text': ['', 'Policy', 'number', ''],
+            'conf': conf,
+            'left': [0, 10, 60, 0],
+            'top': [0, 20, 20, 0],
+            'width': [100, 40, 50, 0],
+            'height': [50, 10, 10, 0],
+            'block_num': [1, 1, 1, 1],
+            'par_num': [1, 1, 1, 1],
+            'line_num': [0, 1, 1, 1],
+        }
+    return fake
+
+
+@pytest.mark.parametrize('conf', [
+    [-1, 96.5, 88.0, -1],
+    ['-1', '96.5', '88', '-1'],
+    ['-1', '96.5', '88', ''],
+    [-1, 96.5, 0, -1],
+    ['-1', '96.5', '0', None],
+])
+def test_tesseract_response_confidences(monkeypatch, conf):
+    monkeypatch.setattr(pytesseract, 'image_to_data', image_to_data(conf))
+    response = ocr_engines.tesseract_response(np.full((200, 100), 255, dtype=np.uint8))
+
+    words = [b for b in response['Blocks'] if b['BlockType'] == 'WORD']
+    lines = [b for b in response['Blocks'] if b['BlockType'] == 'LINE']
+    expected = [float(conf[1]), float(conf[2])]
+    assert [w['Text'] for w in words] == ['Policy', 'number']
+    assert [w['Confidence'] for w in words] == expected
+    assert len(lines) == 1
+    assert ocr_engines.mean_confidence(response) == pytest.approx(sum(expected) / 2)
+    assert response['Engine'] == 'tesseract'
+
+
+def test_ocr_engine_is_abstract():
+    with pytest.raises(TypeError):
+        ocr_engines.OcrEngine()
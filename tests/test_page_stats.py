@@ -0,0 +1,51 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('skimage')
+
+import page_stats  # noqa: E402
+
+
+def entropy_2(image):
+    # what skimage.measure.shannon_entropy(image, base=2) computes
+    _, counts = np.unique(image, return_counts=True)
+    p = counts / counts.sum()
+    return -(p * np.log2(p)).sum()
+
+
+@pytest.mark.parametrize('shape', [(7, 9), (8, 10), (5, 7, 3), (6, 5, 3)])
+@pytest.mark.parametrize('high', [256, 4])
+def test_histogram_stats_match_pixel_stats(shape, high):
+    rng = np.random.default_rng(sum(shape) * high)
+    image = rng.integers(0, high, size=shape, dtype=np.uint8)
+    # a chunk size that doesn't divide the page, so the chunked histogram is exercised too
+    hist = page_stats.page_histogram(image, chunk_pixels=17)
+    assert (hist == np.bincount(image.ravel(), minlength=256)).all()
+
+    stats = {k: v[0] for k, v in page_stats.histogram_stats(hist[None, :]).items()}
+    assert stats['img_mean'] == pytest.approx(np.mean(image))
+    assert stats['img_average'] == pytest.approx(np.average(image))
+    assert stats['img_median'] == np.median(image)
+    assert stats['img_std'] == pytest.approx(np.std(image))
+    assert stats['img_variance'] == pytest.approx(np.var(image))
+    assert stats['shannon_entropy_2'] == pytest.approx(entropy_2(image))
+
+
+@pytest.mark.parametrize('pixels, median', [
+    ([0, 0, 1, 255], 0.5),
+    ([0, 1, 254, 255], 127.5),
+    ([3], 3),
+    ([9, 0, 9], 9),
+])
+def test_histogram_median_between_levels(pixels, median):
+    image = np.array(pixels, dtype=np.uint8).reshape(1, -1)
+    hist = page_stats.page_histogram(image)
+    assert page_stats.histogram_stats(hist[None, :])['img_median'][0] == median == np.median(image)
+
+
+def test_histogram_entropy_matches_skimage():
+    measure = pytest.importorskip('skimage.measure')
+    image = np.random.default_rng(0).integers(0, 256, size=(31, 17, 3), dtype=np.uint8)
+    hist = page_stats.page_histogram(image)
+    assert page_stats.histogram_stats(hist[None, :])['shannon_entropy_2'][0] == pytest.approx(
+        measure.shannon_entropy(image, base=2))
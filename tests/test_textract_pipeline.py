@@ -0,0 +1,155 @@
+import json
+import threading
+
+import pytest
+
+pytest.importorskip('botocore')
+from botocore.exceptions import ClientError  # noqa: E402
+
+import textract_pipeline  # noqa: E402
+from textract_pipeline import AdaptiveLimiter, FakeTextract, call_with_backoff, run_pages  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(textract_pipeline, 'backoff_delay', lambda attempt: 0.001)
+
+
+def client_error(code, status=400):
+    return ClientError({'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}},
+                       'DetectDocumentText')
+
+
+def pages(n):
+    return [f'fake/page_thumbnails/cytora_init0001-{i}.png' for i in range(n)]
+
+
+def detect(fake):
+    return lambda page: {'blocks': len(fake.detect_document_text(Document={'S3Object': {'Name': page}})['Blocks'])}
+
+
+def test_limiter_shrinks_on_throttling_and_grows_back():
+    limiter = AdaptiveLimiter(8)
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert (limiter.limit, limiter.throttled) == (2, 2)
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.limit == 1
+
+    # every `limit` successes in a row add one, up to max_concurrency
+    for _ in range(1 + 2 + 3 + 4 + 5 + 6 + 7):
+        limiter.on_success()
+    assert limiter.limit == 8
+    for _ in range(20):
+        limiter.on_success()
+    assert limiter.limit == 8
+
+
+def test_call_with_backoff_retries_throttling():
+    errors = [client_error('ThrottlingException'), client_error('ProvisionedThroughputExceededException')]
+
+    def fn(page):
+        if errors:
+            raise errors.pop(0)
+        return {'page': page}
+
+    limiter = AdaptiveLimiter(8)
+    res = call_with_backoff(fn, 'p', limiter)
+    assert res == {'page': 'p', 'attempts': 3}
+    assert (limiter.throttled, limiter.limit) == (2, 2)
+
+
+def test_call_with_backoff_gives_up():
+    calls = []
+
+    def fn(page):
+        calls.append(page)
+        raise client_error('InternalServerError', 500)
+
+    with pytest.raises(ClientError):
+        call_with_backoff(fn, 'p', AdaptiveLimiter(4))
+    assert len(calls) == textract_pipeline.MAX_TRANSIENT_ATTEMPTS
+
+    calls.clear()
+
+    def invalid(page):
+        calls.append(page)
+        raise client_error('InvalidParameterException')
+
+    with pytest.raises(ClientError):
+        call_with_backoff(invalid, 'p', AdaptiveLimiter(4))
+    assert len(calls) == 1
+
+
+def test_run_pages_against_throttling_fake(monkeypatch):
+    fake = FakeTextract(latency=0.01, throttle_above=3, words=5)
+    limiters = []
+
+    class RecordingLimiter(AdaptiveLimiter):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.limits = [self.limit]
+            limiters.append(self)
+
+        def on_throttle(self):
+            super().on_throttle()
+            self.limits.append(self.limit)
+
+        def on_success(self):
+            super().on_success()
+            self.limits.append(self.limit)
+
+    monkeypatch.setattr(textract_pipeline, 'AdaptiveLimiter', RecordingLimiter)
+    results = run_pages(pages(60), detect(fake), concurrency=8, max_attempts=20)
+
+    assert len(results) == 60
+    assert all('err' not in r and r['blocks'] == 6 for r in results)
+    limiter = limiters[0]
+    assert limiter.throttled > 0
+    assert fake.calls == 60 + limiter.throttled
+    assert sum(r['attempts'] for r in results) == fake.calls
+    # the cap came down from 8 under throttling and went up again after successes
+    low = limiter.limits.index(min(limiter.limits))
+    assert min(limiter.limits) <= 3
+    assert max(limiter.limits[low:]) > min(limiter.limits)
+
+
+def test_run_pages_caps_concurrency():
+    fake = FakeTextract(latency=0.02, throttle_above=100)
+    peak, lock = [0], threading.Lock()
+
+    def fn(page):
+        with lock:
+            peak[0] = max(peak[0], fake.in_flight + 1)
+        return detect(fake)(page)
+
+    results = run_pages(pages(24), fn, concurrency=4)
+    assert len(results) == 24 and all('err' not in r for r in results)
+    assert peak[0] <= 4
+
+
+def test_run_pages_resumes_from_results_file(tmp_path):
+    results_file = str(tmp_path / 'results.jsonl')
+    fake = FakeTextract(latency=0.0, throttle_above=100)
+    broken = set(pages(10)[::3])
+
+    def flaky(page):
+        if page in broken:
+            raise ValueError(f'cannot read {page}')
+        return detect(fake)(page)
+
+    first = run_pages(pages(10), flaky, concurrency=4, results_file=results_file)
+    assert sorted(r['file'] for r in first if 'err' in r) == sorted(broken)
+    assert textract_pipeline.load_completed(results_file) == set(pages(10)) - broken
+
+    # only the pages without a result are sent again
+    seen = []
+    broken.clear()
+    second = run_pages(pages(10), lambda page: seen.append(page) or flaky(page), concurrency=4,
+                       results_file=results_file)
+    assert sorted(seen) == sorted(pages(10)[::3])
+    assert all('err' not in r for r in second)
+    assert textract_pipeline.load_completed(results_file) == set(pages(10))
+    with open(results_file) as f:
+        assert len([json.loads(line) for line in f]) == 10 + len(seen)